@@ -68,6 +68,11 @@ def totimestamp(v):
 class PublicApi(object):
     BASE_URL = 'https://api.bitfinex.com/'
 
+    def __init__(self):
+        # Keep connections alive between requests to skip TCP and TLS
+        # handshakes.
+        self._session = requests.Session()
+
     def public_req(self, path, params=None):
         url = self.BASE_URL + path
         logger.debug('public_req %s %s', path, params)
@@ -75,8 +80,8 @@ class PublicApi(object):
         for i in range(MAX_RETRY):
             timeout = False
             try:
-                resp = requests.get(url, params=params, verify=True,
-                                    timeout=REQUEST_TIMEOUT)
+                resp = self._session.get(url, params=params, verify=True,
+                                         timeout=REQUEST_TIMEOUT)
             except requests.exceptions.Timeout:
                 timeout = True
 
@@ -208,8 +213,8 @@ class AuthedReadonlyApi(PublicApi):
         for i in range(MAX_RETRY):
             headers = self._headers(path, params or {})
             try:
-                resp = requests.post(url, headers=headers, verify=True,
-                                     timeout=REQUEST_TIMEOUT)
+                resp = self._session.post(url, headers=headers, verify=True,
+                                          timeout=REQUEST_TIMEOUT)
             except (requests.exceptions.ConnectionError,
                     requests.exceptions.Timeout):
                 if allow_retry:
@@ -288,6 +293,13 @@ class AuthedReadonlyApi(PublicApi):
         }
         return self._normalize(self.auth_req('v1/order/cancel', body, allow_retry=True))
 
+    def cancel_multiple_orders(self, ids):
+        """Cancels multiple orders in one request."""
+        body = {
+            'order_ids': list(ids),
+        }
+        return self.auth_req('v1/order/cancel/multi', body, allow_retry=True)
+
     # 55 is not enough
     @rate_limit(60)
     def orders_history(self):
@@ -438,6 +450,25 @@ class FullApi(AuthedReadonlyApi):
         # already be created at server side.
         return self._normalize(self.auth_req('v1/order/new', body, allow_retry=False))
 
+    def new_multiple_limit_orders(self, orders):
+        """Creates multiple limit orders in one request.
+        :param orders: List of dicts with 'symbol', 'amount', 'price' and
+                       'side'
+        """
+        body = {
+            'orders': [{
+                'symbol': order['symbol'],
+                'amount': str(order['amount']),
+                'price': str(order['price']),
+                'exchange': 'bitfinex',
+                'side': order['side'],
+                'type': 'exchange limit',
+            } for order in orders],
+        }
+        # Do not retry for the same reason as new_limit_order.
+        return self._normalize(
+            self.auth_req('v1/order/new/multi', body, allow_retry=False))
+
     def transfer_wallet(self, currency, amount, wallet_from, wallet_to):
         """Transfer available balances between wallets.
         :param currency: 'USD', 'BTC', or other crypto currencies
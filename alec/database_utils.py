@@ -4,11 +4,27 @@ class DatabaseManager(object):
     def __init__(self, db):
         self.conn = sqlite3.connect(db)
         self.cur = self.conn.cursor()
+        # Every execute() commits. WAL with synchronous=NORMAL makes a commit
+        # an append to the log instead of a full sync of the database.
+        self.cur.execute('PRAGMA journal_mode=WAL')
+        self.cur.execute('PRAGMA synchronous=NORMAL')
 
     def execute(self, *arg):
         self.cur.execute(*arg)
         self.conn.commit()
         return self.cur
 
+    def executemany(self, *arg):
+        self.cur.executemany(*arg)
+        self.conn.commit()
+        return self.cur
+
+    def executemany_all(self, statements):
+        """Runs executemany() for each (sql, rows) and commits them once."""
+        with self.conn:
+            for sql, rows in statements:
+                self.cur.executemany(sql, rows)
+        return self.cur
+
     def __del__(self):
         self.conn.close()
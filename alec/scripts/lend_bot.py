@@ -7,6 +7,7 @@ import argparse
 import datetime
 import logging
 import os
+import threading
 import time
 
 import pytz
@@ -48,8 +49,17 @@ class LendBot(object):
     def run(self):
         while True:
             try:
+                # The public trades request does not depend on the account
+                # info, so fetch it while the authenticated requests run.
+                errors = []
+                thread = threading.Thread(target=self.fetch_public_trades,
+                                          args=(errors,))
+                thread.daemon = True
+                thread.start()
                 self.get_account_info()
-                self.get_public_trades()
+                thread.join()
+                if errors:
+                    raise errors[0]
                 sleep_time = self.routine()
                 time.sleep(sleep_time)
             except BitfinexClientError as e:
@@ -77,6 +87,8 @@ class LendBot(object):
         return self.NORMAL_INTERVAL
 
     def get_account_info(self):
+        # Authenticated requests are kept sequential since v1 rejects a nonce
+        # which is smaller than the previous one.
         for wallet in self._v1_client.balances():
             if wallet['currency'].upper() == self._currency and (
                     wallet['type'] == 'deposit'):
@@ -88,6 +100,13 @@ class LendBot(object):
     def get_public_trades(self):
         self._trades = self._v2_client.trades('f' + self._currency)
 
+    def fetch_public_trades(self, errors):
+        """Call get_public_trades and keep its exception in errors."""
+        try:
+            self.get_public_trades()
+        except Exception as e:
+            errors.append(e)
+
     def lend_strategy(self):
         logger.debug('wallet: %s', self._wallet)
         logger.debug('credit: %s', self._credits)
@@ -4,10 +4,10 @@
 
 import argparse
 import datetime
-import decimal
 import re
 import time
 
+import numpy as np
 import pytz
 from slacker import Slacker
 
@@ -15,18 +15,26 @@ from alec import config
 
 SLACK = Slacker(config.SLACK_TOKEN) if config.SLACK_ENABLE else None
 
+TIMEZONE = pytz.timezone('Asia/Taipei')
+
 REGEXP = re.compile(r'Executed.*pair: (\w+), amount: (-?\d+\.\d+)'
                     r'.*avg_price: (\d+\.\d+)')
 OLD_REGEXP = re.compile(r'Executed.*pair: (\w+), amount: (-?\d+\.\d+), '
                         r'price: (\d+\.\d+)')
 
+# Derived from the static hbot config, so compute them once at import.
+SYMBOLS = tuple(sorted(
+    symbol[:3] for symbol in config.TRADE_HBOT_CONFIG.get('symbols', {})))
+SYMBOL_INDEX = {symbol: i for i, symbol in enumerate(SYMBOLS)}
+EARN_PERCENT = {
+    symbol[:3]: 1 - (1 / (cfg['percent'] ** cfg['profit']))
+    for symbol, cfg in config.TRADE_HBOT_CONFIG.get('symbols', {}).items()}
+
 
 def timestamp_to_string(timestamp):
     """ Return a timestamp string with Taipei timezone """
-    zone = pytz.timezone('Asia/Taipei')
-    local_time = datetime.datetime.fromtimestamp(int(timestamp), zone)
-    return (str(local_time.strftime('%Y-%m-%d')),
-            str(local_time.strftime('%H:%M:%S')))
+    local_time = datetime.datetime.fromtimestamp(int(timestamp), TIMEZONE)
+    return local_time.strftime('%Y-%m-%d'), local_time.strftime('%H:%M:%S')
 
 
 def log(text, emoji=None):
@@ -42,24 +50,14 @@ def log(text, emoji=None):
 
 
 def check_state(date=None):
-    statistic = {}
-    symbols = []
-    earn_percent = {}
-    for symbol in config.TRADE_HBOT_CONFIG['symbols']:
-        symbols.append(symbol[:3])
-        profit_percent = (config.TRADE_HBOT_CONFIG['symbols'][symbol]['percent'] **
-                          config.TRADE_HBOT_CONFIG['symbols'][symbol]['profit'])
-        earn_percent[symbol[:3]] = 1 - (1 / profit_percent)
-    for symbol in symbols:
-        statistic[symbol] = {'buy': (0, 0), 'sell': (0, 0)}
-
     day_time = ''
     if not date:
         (date, day_time) = timestamp_to_string(time.time())
 
-    def add(t1, t2):
-        return tuple(u + v for u, v in zip(t1, t2))
-
+    # Collect executed orders column by column and reduce them with numpy.
+    indexes = []
+    amounts = []
+    prices = []
     with open('log') as f:
         for line in f:
             if not line.startswith(date):
@@ -70,21 +68,24 @@ def check_state(date=None):
                 if not m:
                     continue
             pair, amount, avg_price = m.groups()
-            amount = decimal.Decimal(amount)
-            avg_price = decimal.Decimal(avg_price)
 
-            symbol = pair[:-3]
-            if symbol not in symbols:
+            index = SYMBOL_INDEX.get(pair[:-3])
+            if index is None:
                 continue
-
-            if amount > 0:
-                action = 'buy'
-            else:
-                action = 'sell'
-                amount = -amount
-
-            statistic[symbol][action] = add(
-                statistic[symbol][action], (1, amount * avg_price))
+            indexes.append(index)
+            amounts.append(float(amount))
+            prices.append(float(avg_price))
+
+    indexes = np.array(indexes, dtype=np.intp)
+    amounts = np.array(amounts, dtype=np.float64)
+    values = np.abs(amounts) * np.array(prices, dtype=np.float64)
+    is_buy = amounts > 0
+    buy_counts = np.bincount(indexes[is_buy], minlength=len(SYMBOLS))
+    buy_sums = np.bincount(indexes[is_buy], weights=values[is_buy],
+                           minlength=len(SYMBOLS))
+    sell_counts = np.bincount(indexes[~is_buy], minlength=len(SYMBOLS))
+    sell_sums = np.bincount(indexes[~is_buy], weights=values[~is_buy],
+                            minlength=len(SYMBOLS))
 
     print(date + ' ' + day_time)
     print('SYM: %12s\t%12s\t%12s\t%12s\t%12s' % (
@@ -95,10 +96,10 @@ def check_state(date=None):
     total_sell_sum = 0
     total_earn = 0
     slack_msg = date + ' ' + day_time + ' '
-    for symbol, d in sorted(statistic.items()):
-        buy_count, buy_sum = map(float, d['buy'])
-        sell_count, sell_sum = map(float, d['sell'])
-        earn = sell_sum * earn_percent[symbol]
+    for i, symbol in enumerate(SYMBOLS):
+        buy_count, buy_sum = buy_counts[i], buy_sums[i]
+        sell_count, sell_sum = sell_counts[i], sell_sums[i]
+        earn = sell_sum * EARN_PERCENT[symbol]
         total_buy_sum += buy_sum
         total_buy_count += buy_count
         total_sell_sum += sell_sum
@@ -3,7 +3,9 @@
 
 from __future__ import print_function
 
+import argparse
 import json
+import logging
 import time
 
 from slacker import Slacker
@@ -12,6 +14,10 @@ from ws4py.client import WebSocketBaseClient
 from alec import config
 
 slack = Slacker(config.SLACK_TOKEN) if config.SLACK_ENABLE else None
+logger = logging.getLogger(__name__)
+
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
 
 
 def log(text):
@@ -21,6 +27,10 @@ def log(text):
 
 
 class TickerMonitor(WebSocketBaseClient):
+    # Bitfinex accepts subscribe messages back-to-back on one connection, so
+    # only keep a small gap between them to stay under the rate limit.
+    SUBSCRIBE_INTERVAL = 0.06
+
     def __init__(self, symbols, threshold=0.01, window_size=30):
         super(TickerMonitor, self).__init__(config.BFX_WS_ENDPOINT)
         self._threshold = threshold
@@ -38,7 +48,7 @@ class TickerMonitor(WebSocketBaseClient):
                     'channel': 'ticker',
                     'symbol': symbol
                 }))
-            time.sleep(0.5)
+            time.sleep(self.SUBSCRIBE_INTERVAL)
 
     def received_message(self, message):
         data = json.loads(message.data)
@@ -71,13 +81,31 @@ class TickerMonitor(WebSocketBaseClient):
         self._prices[symbol] = self._prices[symbol][-self._window_size:]
         self._moving_average[symbol] = (
             sum(self._prices[symbol]) / len(self._prices[symbol]))
-        print('MA[%s]: %.2f' % (symbol, self._moving_average[symbol]))
+        logger.debug('MA[%s]: %.2f', symbol, self._moving_average[symbol])
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true')
+    opts = parser.parse_args()
+
+    if opts.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig()
+
+    delay = RECONNECT_MIN_DELAY
     while True:
         ws = TickerMonitor(config.PRICE_MONITOR_PAIRS,
                            config.PRICE_MONITOR_THRESHOLD,
                            config.PRICE_MONITOR_WINDOW_SIZE)
-        ws.connect()
-        ws.run()
+        try:
+            ws.connect()
+            ws.run()
+            delay = RECONNECT_MIN_DELAY
+        except Exception as e:
+            # Back off so a flapping endpoint is not hammered with reconnects.
+            logger.warning('Connection error: %s, reconnect in %d seconds',
+                           e, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
@@ -5,6 +5,7 @@ from __future__ import print_function
 
 import csv
 import datetime
+import re
 import sys
 
 USD = 'USD'
@@ -14,6 +15,11 @@ FUNDCOST_TEXT = 'funding cost'
 FUNDFEE_TEXT = 'Unused Margin Funding Fee'
 FUNDPAY_TEXT = 'Funding Payment'
 
+# Matches any of the ledger descriptions above in a single scan.
+DESC_REGEXP = re.compile('|'.join(
+    re.escape(text) for text in
+    [POSITION_TEXT, FEE_TEXT, FUNDCOST_TEXT, FUNDFEE_TEXT, FUNDPAY_TEXT]))
+
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
@@ -32,31 +38,29 @@ class ProfitCalc(object):
         fees = []
         fundcosts = []
         fundpays = []
+        categories = {
+            POSITION_TEXT: positions,
+            FEE_TEXT: fees,
+            FUNDCOST_TEXT: fundcosts,
+            FUNDFEE_TEXT: fundcosts,
+            FUNDPAY_TEXT: fundpays,
+        }
 
         for csvfile in self._csvfiles:
             with open(csvfile, 'r') as f:
-                data = f.read()
-
-            reader = csv.reader(data.splitlines())
-            for row in reader:
-                currency = row[0]
-                if currency != USD:
-                    continue
-
-                desc = row[2]
-                amount = float(row[3])
-                datestr = row[5]
-
-                dates.append(
-                    datetime.datetime.strptime(datestr, DATETIME_FORMAT))
-                if POSITION_TEXT in desc:
-                    positions.append(amount)
-                elif FEE_TEXT in desc:
-                    fees.append(amount)
-                elif FUNDCOST_TEXT in desc or FUNDFEE_TEXT in desc:
-                    fundcosts.append(amount)
-                elif FUNDPAY_TEXT in desc:
-                    fundpays.append(amount)
+                for row in csv.reader(f):
+                    if row[0] != USD:
+                        continue
+
+                    desc = row[2]
+                    amount = float(row[3])
+                    datestr = row[5]
+
+                    dates.append(
+                        datetime.datetime.strptime(datestr, DATETIME_FORMAT))
+                    m = DESC_REGEXP.search(desc)
+                    if m:
+                        categories[m.group(0)].append(amount)
 
         total_margin = sum(positions)
         total_fees = sum(fees)
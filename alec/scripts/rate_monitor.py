@@ -3,29 +3,80 @@
 
 from __future__ import print_function
 
+import argparse
+import contextlib
+import functools
+import heapq
+import logging
+import queue
+import threading
 import time
 from decimal import Decimal
 
 from btfxwss import BtfxWss
-from slacker import Slacker
 
 from alec import config
+from alec import slack_utils
 from alec.api import BitfinexClientError
 from alec.api import bitfinex_v1_rest
 from alec.api import bitfinex_v2_rest
 
-slack = Slacker(config.SLACK_TOKEN) if config.SLACK_ENABLE else None
+slack = (slack_utils.SlackPoster(config.SLACK_TOKEN, config.SLACK_CHANNEL)
+         if config.SLACK_ENABLE else None)
+logger = logging.getLogger(__name__)
+
+# Minimum available amount to create an offer.
+MIN_LEND_AMOUNT = Decimal(50)
+# Keep a tiny amount out of the offer to avoid "not enough balance" errors.
+LEND_DUST = Decimal('0.000001')
+
+
+# Slack messages logged inside batch_log() of the current thread.
+_log_batch = threading.local()
 
 
 def log(text):
     print(text)
     if slack:
-        slack.chat.post_message(config.SLACK_CHANNEL, text)
+        lines = getattr(_log_batch, 'lines', None)
+        if lines is not None:
+            lines.append(text)
+        else:
+            slack.post_message(text)
+
+
+@contextlib.contextmanager
+def batch_log():
+    """Merge the slack messages logged inside the block into one post."""
+    _log_batch.lines = []
+    try:
+        yield
+    finally:
+        lines = _log_batch.lines
+        _log_batch.lines = None
+        if slack and lines:
+            slack.post_message('\n'.join(lines))
 
 
 class RateMonitor(object):
+    # Range of intervals to check whether Btfxwss has created a queue. The
+    # interval grows since a queue is only created on its first message.
+    QUEUE_RETRY_MIN_INTERVAL = 0.05
+    QUEUE_RETRY_MAX_INTERVAL = 1
+    # Maximum number of messages forwarded from one queue at once, so that a
+    # busy queue doesn't starve the others.
+    MAX_BATCH_SIZE = 64
+    # Range of intervals to check account information. The interval grows
+    # while nothing comes and never exceeds the old main loop interval.
+    ACCOUNT_POLL_MIN_INTERVAL = 0.05
+    ACCOUNT_POLL_MAX_INTERVAL = 0.5
+    # Maximum number of trades processed from a trades snapshot. Only the
+    # newest ones matter, and a reconnect may replay a lot of history.
+    MAX_TRADE_SNAPSHOT = 128
+
     def __init__(self, symbols):
         self.DEBUG = True
+        self._inbox = queue.Queue()
         self._rest_client = bitfinex_v1_rest.FullApi()
         self._wss = None
         self._symbols = symbols
@@ -50,72 +101,121 @@ class RateMonitor(object):
             self._funding['latest_rate'] = 0.0
 
     def run(self):
+        self.forward_account_info([
+            (lambda: self._wss.opened, self.received_opened),
+            (lambda: self._wss.wallets, self.received_wallets),
+            (lambda: self._wss.wallet_update, self.received_wallet_update),
+            (lambda: self._wss.credits, self.received_credits),
+            (lambda: self._wss.offer_new, self.received_offer_new),
+            (lambda: self._wss.offer_cancel, self.received_offer_cancel),
+            (lambda: self._wss.credit_close, self.received_credit_close),
+            (lambda: self._wss.credit_update, self.received_credit_update),
+            (lambda: self._wss.offer_update, print),
+        ])
+        for symbol in self._symbols:
+            self.watch(functools.partial(self._wss.trades, symbol),
+                       functools.partial(self.received_trades, symbol))
+
+        # Handlers are only called from this thread, so they don't need any
+        # locking.
         while True:
-            self.check_system()
-            self.check_account_info()
-            self.check_trades()
-            time.sleep(0.5)
+            handler, messages = self._inbox.get()
+            with batch_log():
+                for message in messages:
+                    handler(message)
 
-    def check_system(self):
-        try:
-            server_q = self._wss.opened
-            while not server_q.empty():
-                server_q.get()
-                self.reset()
-                self.connect()
-        except KeyError:
-            # KeyError means Btfxwss doesn't get related information yet.
-            # It's fine to pass and check in the next time.
-            pass
-
-    def check_account_info(self):
-        try:
-            wallets_q = self._wss.wallets
-            while not wallets_q.empty():
-                self.received_wallets(wallets_q.get())
-
-            wallet_update_q = self._wss.wallet_update
-            while not wallet_update_q.empty():
-                self.received_wallet_update(wallet_update_q.get())
-
-            credits_q = self._wss.credits
-            while not credits_q.empty():
-                self.received_credits(credits_q.get())
-
-            offer_new_q = self._wss.offer_new
-            while not offer_new_q.empty():
-                self.received_offer_new(offer_new_q.get())
-
-            offer_cancel_q = self._wss.offer_cancel
-            while not offer_cancel_q.empty():
-                self.received_offer_cancel(offer_cancel_q.get())
-
-            credit_close_q = self._wss.credit_close
-            while not credit_close_q.empty():
-                self.received_credit_close(credit_close_q.get())
-
-            credit_update_q = self._wss.credit_update
-            while not credit_update_q.empty():
-                self.received_credit_update(credit_update_q.get())
-
-            q = self._wss.offer_update
-            while not q.empty():
-                print(q.get())
-        except KeyError:
-            # KeyError means Btfxwss doesn't get related information yet.
-            # It's fine to pass and check in the next time.
-            pass
-
-    def check_trades(self):
-        for symbol in self._symbols:
+    @staticmethod
+    def get_batch(q, size):
+        """Get at most size messages from a Btfxwss queue without blocking.
+
+        qsize() of a multiprocessing queue may count messages which can't be
+        got yet, so stop at queue.Empty instead of trusting it.
+
+        :param q: The Btfxwss queue
+        :param size: Maximum number of messages
+        """
+        messages = []
+        for _ in range(size):
             try:
-                trades_q = self._wss.trades(symbol)
-                while not trades_q.empty():
-                    self.received_trades(symbol, trades_q.get())
-            except KeyError:
-                # KeyError means Btfxwss doesn't get related information yet.
-                # It's fine to pass and check in the next time.
-                pass
+                messages.append(q.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def forward_account_info(self, sources):
+        """Forward messages of connection and account queues to the inbox.
+
+        The queues share one thread and are drained in the given order, so
+        that e.g. a new offer is handled before its cancellation no matter
+        how the threads are scheduled.
+
+        :param sources: List of (get_queue, handler) in the order to handle
+        """
+        def forward():
+            interval = self.ACCOUNT_POLL_MIN_INTERVAL
+            while True:
+                forwarded = False
+                for get_queue, handler in sources:
+                    try:
+                        q = get_queue()
+                    except KeyError:
+                        # KeyError means Btfxwss doesn't get related
+                        # information yet. It's fine to pass and check in the
+                        # next time.
+                        continue
+                    # Drain the queue before the next one to keep the order.
+                    while True:
+                        messages = self.get_batch(q, self.MAX_BATCH_SIZE)
+                        if not messages:
+                            break
+                        self._inbox.put((handler, messages))
+                        forwarded = True
+                        if len(messages) < self.MAX_BATCH_SIZE:
+                            break
+                if forwarded:
+                    interval = self.ACCOUNT_POLL_MIN_INTERVAL
+                else:
+                    time.sleep(interval)
+                    interval = min(interval * 2,
+                                   self.ACCOUNT_POLL_MAX_INTERVAL)
+
+        thread = threading.Thread(target=forward)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, get_queue, handler):
+        """Forward messages of a Btfxwss queue to the inbox in batches.
+
+        The queue is looked up once, since Btfxwss creates each queue once
+        and keeps it across reconnects.
+
+        :param get_queue: Function which returns the Btfxwss queue
+        :param handler: Function to call with each message of the queue
+        """
+        def forward():
+            interval = self.QUEUE_RETRY_MIN_INTERVAL
+            while True:
+                try:
+                    q = get_queue()
+                    break
+                except KeyError:
+                    # KeyError means Btfxwss doesn't get related information
+                    # yet. It's fine to wait and check in the next time.
+                    time.sleep(interval)
+                    interval = min(interval * 2,
+                                   self.QUEUE_RETRY_MAX_INTERVAL)
+            while True:
+                messages = [q.get()]
+                messages.extend(self.get_batch(q, self.MAX_BATCH_SIZE - 1))
+                self._inbox.put((handler, messages))
+
+        thread = threading.Thread(target=forward)
+        thread.daemon = True
+        thread.start()
+
+    def received_opened(self, unused_message):
+        self.reset()
+        self.connect()
 
     def received_wallets(self, message):
         # pylint: disable=W0612
@@ -160,7 +260,17 @@ class RateMonitor(object):
         # pylint: disable=W0612
         data, ts = message
         if isinstance(data[0], list):
-            for transaction in data[0]:
+            transactions = data[0]
+            if len(transactions) > self.MAX_TRADE_SNAPSHOT:
+                logger.debug('%s: drop %d old trades from snapshot', symbol,
+                             len(transactions) - self.MAX_TRADE_SNAPSHOT)
+                # Keep the newest trades by timestamp (the second field),
+                # and process them oldest first.
+                transactions = sorted(
+                    heapq.nlargest(self.MAX_TRADE_SNAPSHOT, transactions,
+                                   key=lambda t: t[1]),
+                    key=lambda t: t[1])
+            for transaction in transactions:
                 self.process_public_trade(symbol, transaction)
         elif data[0] == 'fte':
             self.process_public_trade(symbol, data[1])
@@ -169,21 +279,27 @@ class RateMonitor(object):
     def process_wallet(self, data):
         if self.DEBUG:
             print(data)
+        # Filter on the raw fields (wallet_type, currency) before wrapping.
+        if data[0] != 'funding' or data[1] != 'USD':
+            return
         wallet = bitfinex_v2_rest.Wallet(data)
-        if wallet.wallet_type == 'funding' and wallet.currency == 'USD':
-            self._funding['total'] = wallet.balance
-            log("Funding usd: %f" % self._funding['total'])
+        self._funding['total'] = wallet.balance
+        log("Funding usd: %f" % self._funding['total'])
 
     def process_credit(self, data):
         if self.DEBUG:
             print(data)
+        # Filter on the raw symbol field before wrapping.
+        if data[1] != 'fUSD':
+            return 0
         credit = bitfinex_v2_rest.Credit(data)
-        if credit.symbol == 'fUSD':
-            if credit.status == 'ACTIVE':
-                self._credits[credit.id] = credit.amount
-                return credit.amount
-            elif credit.status.startswith('CLOSED'):
-                del self._credits[credit.id]
+        if credit.status == 'ACTIVE':
+            self._credits[credit.id] = credit.amount
+            return credit.amount
+        elif credit.status.startswith('CLOSED'):
+            # Credits which were closed before we saw them are not counted in
+            # 'lent'.
+            if self._credits.pop(credit.id, None) is not None:
                 self._funding['lent'] -= credit.amount
                 log('Close a credit, amount: %f' % credit.amount)
                 self.lend_strategy()
@@ -192,49 +308,65 @@ class RateMonitor(object):
     def process_offer(self, data):
         if self.DEBUG:
             print(data)
+        # Filter on the raw symbol field before wrapping.
+        if data[1] != 'fUSD':
+            return
         offer = bitfinex_v2_rest.FundingOffer(data)
-        if offer.symbol == 'fUSD':
-            if offer.status == 'ACTIVE':
-                if offer.id not in self._offers:
-                    self._offers[offer.id] = offer.amount_orig
-                    self._funding['lent'] += offer.amount_orig
-                    log('Create an offer, amount: %f' % offer.amount_orig)
-            elif offer.status == 'CANCEL':
-                self._funding['lent'] -= offer.amount
-                log('Cancel an offer, amount: %f' % offer.amount)
-                del self._offers[offer.id]
-            elif offer.status.startswith('EXECUTED'):
-                if offer.id not in self._offers:
-                    self._funding['lent'] += offer.amount_orig
-                    log('Create an offer, amount: %f' % offer.amount_orig)
-                else:
-                    del self._offers[offer.id]
+        offers = self._offers
+        funding = self._funding
+        status = offer.status
+        if status == 'ACTIVE':
+            if offer.id not in offers:
+                amount = offer.amount_orig
+                offers[offer.id] = amount
+                funding['lent'] += amount
+                log('Create an offer, amount: %f' % amount)
+        elif status == 'CANCEL':
+            if offers.pop(offer.id, None) is not None:
+                amount = offer.amount
+                funding['lent'] -= amount
+                log('Cancel an offer, amount: %f' % amount)
+        elif status.startswith('EXECUTED'):
+            if offers.pop(offer.id, None) is None:
+                amount = offer.amount_orig
+                funding['lent'] += amount
+                log('Create an offer, amount: %f' % amount)
 
     def process_public_trade(self, symbol, data):
-        trade = bitfinex_v2_rest.Trade(data)
-        log("%s: Timestamp: %s, Rate: %f, Period: %d, Amount: %f" %
-            (symbol, time.strftime("%H:%M:%S", time.localtime(trade.time)),
-             trade.rate * 100, trade.period, abs(trade.amount)))
-
-        if trade.time > self._funding['latest_ts']:
-            self._funding['latest_ts'] = trade.time
-            self._funding['latest_rate'] = trade.rate
+        # Public trades are the busiest stream. Unpack the raw fields (see
+        # bitfinex_v2_rest.Trade) instead of building a wrapper per trade.
+        # pylint: disable=W0612
+        trade_id, mts, amount, rate, period = data[:5]
+        trade_time = mts / 1000.0
+        # Public trades are too frequent for slack. Only format them when
+        # someone reads the log.
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('%s: Timestamp: %s, Rate: %f, Period: %d, Amount: %f',
+                        symbol,
+                        time.strftime('%H:%M:%S', time.localtime(trade_time)),
+                        rate * 100, period, abs(amount))
+
+        funding = self._funding
+        if trade_time > funding['latest_ts']:
+            funding['latest_ts'] = trade_time
+            funding['latest_rate'] = Decimal(str(rate))
 
     def lend_strategy(self):
-        if 'total' in self._funding and 'lent' in self._funding:
-            available = self._funding['total'] - self._funding['lent']
-        else:
+        funding = self._funding
+        if 'total' not in funding or 'lent' not in funding:
             return
-        if 'available' not in self._funding or (available !=
-                                                self._funding['available']):
+        total = funding['total']
+        lent = funding['lent']
+        available = total - lent
+        if funding.get('available') != available:
             log('total: %f, lent: %f, available: %f' %
-                (self._funding['total'], self._funding['lent'], available))
-            self._funding['available'] = available
+                (total, lent, available))
+            funding['available'] = available
 
         # Re-write the strategy by yourself
-        if available > 50:
+        if available > MIN_LEND_AMOUNT:
             # rate 0 means FRR
-            self.new_offer('USD', available - Decimal(0.000001), 0, 2)
+            self.new_offer('USD', available - LEND_DUST, 0, 2)
 
     def new_offer(self, currency, amount, rate, period):
         """Create an new offer
@@ -264,6 +396,15 @@ class RateMonitor(object):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true')
+    opts = parser.parse_args()
+
+    if opts.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
     log('=' * 30)
     log('RateMonitor started')
     monitor = RateMonitor(config.RATE_MONITOR_SYMBOLS)
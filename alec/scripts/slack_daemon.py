@@ -4,10 +4,17 @@
 import json
 import logging
 import pprint
+import socket
 
 import websocket
 from slacker import Slacker
 
+try:
+    # Every RTM frame is parsed, so prefer the faster parser when installed.
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 
 logger = logging.getLogger('slack_daemon')
 
@@ -17,11 +24,17 @@ class SlackDaemonError(Exception):
 
 
 class SlackClient(object):
+    # Maximum length of a message sent through RTM.
+    MAX_MESSAGE_LENGTH = 4000
+    # Marker of a code block in a message.
+    CODE_FENCE = '```'
+
     def __init__(self, token, channel):
         self._slack = Slacker(token)
         self._channel = channel
         self._id = None
         self._mention = None
+        self._mention_len = 0
         self._channel_id = None
         self._ws = None
         self._commands = {'help': self.help, 'ping': self.pong}
@@ -31,23 +44,18 @@ class SlackClient(object):
         self._id = response.body['self']['id']
         logger.debug('ID: %s', self._id)
         self._mention = '<@%s>' % self._id
+        self._mention_len = len(self._mention)
         logger.debug('mention: %s', self._mention)
 
-        logger.debug('response: %s', pprint.pformat(response.body))
-
-        # Find the target channel/group.
+        # pformat walks the whole rtm.start response, only do it when needed.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('response: %s', pprint.pformat(response.body))
 
-        # Search in public channels.
-        for ch in response.body['channels']:
-            logging.debug('channel %s: %s', ch, pprint.pformat(ch))
-            if ch['name'] == self._channel:
-                self._channel_id = ch['id']
-
-        # Search in private channels, which is called 'groups'.
-        for ch in response.body['groups']:
-            logging.debug('group %s: %s', ch, pprint.pformat(ch))
-            if ch['name'] == self._channel:
-                self._channel_id = ch['id']
+        # Find the target channel/group. Private channels are called 'groups'.
+        name_to_id = {ch['name']: ch['id'] for ch in response.body['channels']}
+        name_to_id.update(
+            (ch['name'], ch['id']) for ch in response.body['groups'])
+        self._channel_id = name_to_id.get(self._channel)
 
         if self._channel_id is None:
             raise SlackDaemonError('can not find channel `%s\'' % self._channel)
@@ -57,7 +65,14 @@ class SlackClient(object):
                                           on_error=self.on_error,
                                           on_close=self.on_close,
                                           on_message=self.on_message)
-        self._ws.run_forever()
+        # Slack already sends valid UTF-8, so skip validating every frame.
+        # Ping to notice a dead connection, and disable Nagle so replies are
+        # sent right away.
+        self._ws.run_forever(
+            sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),),
+            ping_interval=30,
+            ping_timeout=10,
+            skip_utf8_validation=True)
 
     def on_error(self, unused_ws, error):
         logger.error(error)
@@ -67,22 +82,67 @@ class SlackClient(object):
 
     def on_message(self, unused_ws, msg):
         try:
-            data = json.loads(msg)
-            if data.get('type') == 'message':
-                if data['text'].startswith(self._mention):
-                    text = data['text'][len(self._mention):].lstrip()
-                    self.process_command(text)
+            data = json_loads(msg)
+            # Most frames are not mentions of us. Drop them early.
+            if data.get('type') != 'message':
+                return
+            text = data.get('text', '')
+            if not text.startswith(self._mention):
+                return
+            self.process_command(text[self._mention_len:].lstrip())
         except Exception as e:
             logger.exception(e)
 
+    def split_message(self, message):
+        """Splits a long message into chunks which RTM accepts.
+
+        Chunks end at line boundaries unless a line is too long. A code block
+        which spans chunks is closed at the end of one chunk and reopened in
+        the next one, so that it is still rendered as code.
+        """
+        if len(message) <= self.MAX_MESSAGE_LENGTH:
+            return [message]
+
+        fence = self.CODE_FENCE
+        # Leave room to reopen and close a code block.
+        limit = self.MAX_MESSAGE_LENGTH - 2 * (len(fence) + 1)
+        pieces = []
+        for line in message.splitlines(True):
+            pieces.extend(line[i:i + limit]
+                          for i in range(0, len(line), limit))
+
+        texts = []
+        text = ''
+        for piece in pieces:
+            if len(text) + len(piece) > limit:
+                texts.append(text)
+                text = ''
+            text += piece
+        texts.append(text)
+
+        chunks = []
+        in_code = False
+        for text in texts:
+            reopen = in_code
+            if text.count(fence) % 2:
+                in_code = not in_code
+            if reopen:
+                text = fence + '\n' + text
+            if in_code:
+                text += fence if text.endswith('\n') else '\n' + fence
+            chunks.append(text)
+        return chunks
+
     def post_message(self, message):
-        self._ws.send(
-            json.dumps({
-                'type': 'message',
-                'channel': self._channel_id,
-                'text': message
-            })
-        )
+        # RTM rejects long messages, so send them in chunks.
+        for text in self.split_message(message):
+            self._ws.send(
+                json.dumps({
+                    'type': 'message',
+                    'channel': self._channel_id,
+                    'text': text
+                })
+            )
 
     def help(self):
         self.post_message('```Available commands are:\n'
@@ -5,6 +5,8 @@ import argparse
 import datetime
 import logging
 import os
+import random
+import time
 
 from alec import config
 from alec.scripts.trade_jbot import DISABLE_JBOT_TAG
@@ -13,6 +15,9 @@ from alec.scripts.slack_daemon import SlackClient
 
 logger = logging.getLogger('slack_daemon')
 
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
 
 class SlackClientJbotError(Exception):
     pass
@@ -26,8 +31,12 @@ class SlackClientJbot(SlackClient):
     def disable_jbot(self):
         """Disables trade_jbot by a disabling tag."""
         logger.info('Disable trade_jbot')
-        with open(DISABLE_JBOT_TAG, 'w') as f:
+        # Write to a temporary file and rename it, so trade_jbot never sees a
+        # partially written tag.
+        tmp_path = DISABLE_JBOT_TAG + '.tmp'
+        with open(tmp_path, 'w') as f:
             f.write('Disabled from slack at %s' % datetime.datetime.now())
+        os.rename(tmp_path, DISABLE_JBOT_TAG)
 
     def enable_jbot(self):
         """Enables trade_jbot by removing the disabling tag."""
@@ -65,5 +74,15 @@ if __name__ == '__main__':
 
     client = SlackClientJbot(config.SLACK_TOKEN, config.SLACK_CHANNEL)
 
+    delay = RECONNECT_MIN_DELAY
     while True:
-        client.start()
+        try:
+            client.start()
+        except Exception as e:
+            logger.exception(e)
+        else:
+            delay = RECONNECT_MIN_DELAY
+        # Back off with jitter so a rejected handshake does not turn into a
+        # tight reconnect loop against the RTM endpoint.
+        time.sleep(delay + random.random())
+        delay = min(delay * 2, RECONNECT_MAX_DELAY)
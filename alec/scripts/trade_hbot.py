@@ -6,21 +6,22 @@
 from __future__ import print_function
 
 import argparse
+import atexit
+import concurrent.futures
 import datetime
+import functools
 import logging
 import math
+import queue
+import threading
 import time
 import os
-from decimal import Decimal
 
-import json
 import pytz
-import requests
-import slacker
 from btfxwss import BtfxWss
-from slacker import Slacker
 
 from alec import config
+from alec import slack_utils
 from alec.api import BitfinexClientError
 from alec.api import bitfinex_v1_rest
 from alec.api import bitfinex_v2_rest
@@ -32,6 +33,13 @@ LOG_DEBUG = 3
 
 LOG_LEVEL = LOG_INFO
 
+# Type of a pair, cfg['_type'] is set from cfg['type'] by check_config().
+TYPE_CRYPTO = 0
+TYPE_USD = 1
+PAIR_TYPES = {'CRYPTO': TYPE_CRYPTO, 'USD': TYPE_USD}
+
+TIMEZONE = pytz.timezone('Asia/Taipei')
+
 EMOJI_SELL = ':heart:'
 EMOJI_BUY = ':blue_heart:'
 EMOJI_DISCONNECT = ':exclamation:'
@@ -41,42 +49,71 @@ EMOJI_START_LEND = ':arrows_counterclockwise:'
 EMOJI_MOVE_WALLET = ':moneybag:'
 EMOJI_ERROR = ':exclamation:'
 
-SLACK = Slacker(config.SLACK_TOKEN) if config.SLACK_ENABLE else None
+# Slack is posted from a background thread, so a slow slack never blocks
+# the trading loop.
+SLACK = (slack_utils.SlackPoster(config.SLACK_TOKEN, config.SLACK_CHANNEL,
+                                 maxsize=1024)
+         if config.SLACK_ENABLE else None)
+
+# Log file handle, opened on the first log.
+_log_file = None
 
 
 def timestamp_to_string(timestamp):
     """ Return a timestamp string with Taipei timezone """
-    zone = pytz.timezone('Asia/Taipei')
-    local_time = datetime.datetime.fromtimestamp(int(timestamp), zone)
-    return str(local_time.strftime('%Y-%m-%d %H:%M:%S'))
+    local_time = datetime.datetime.fromtimestamp(int(timestamp), TIMEZONE)
+    return local_time.strftime('%Y-%m-%d %H:%M:%S')
 
 
 def log(level, text, emoji=None):
     """ Print a log to file, console, and slack """
+    global _log_file
     timestamp = timestamp_to_string(time.time())
-    with open('log', 'a') as log_fd:
-        log_fd.write(timestamp + '\t' + text + '\n')
+    if _log_file is None:
+        # Line buffered, so every log is still written out right away.
+        _log_file = open('log', 'a', buffering=1)
+        atexit.register(_log_file.close)
+    _log_file.write(timestamp + '\t' + text + '\n')
     if level > LOG_LEVEL:
         return
     print(timestamp + '\t' + text)
-    try:
-        if SLACK:
-            message = text
-            if level == LOG_ERROR:
-                emoji = EMOJI_ERROR
-            if emoji:
-                message = emoji + ' ' + text
-            SLACK.chat.post_message(config.SLACK_CHANNEL, message)
-    except slacker.Error:
-        print('Slack api erorr')
-    except requests.exceptions.HTTPError:
-        print('Slack time out')
-    except json.decoder.JSONDecodeError:
-        print('Slack data error')
+    if SLACK:
+        message = text
+        if level == LOG_ERROR:
+            emoji = EMOJI_ERROR
+        if emoji:
+            message = emoji + ' ' + text
+        SLACK.post_message(message)
 
 
 class WebSocketApi(object):
     """ Wrapper to use BtfxWss. """
+
+    # Range of intervals to check whether Btfxwss has created a queue. The
+    # interval grows since some queues are only created on rare events.
+    QUEUE_RETRY_MIN_INTERVAL = 0.05
+    QUEUE_RETRY_MAX_INTERVAL = 1
+    # Maximum number of messages forwarded from one queue at once, so that a
+    # busy queue doesn't starve the others.
+    MAX_BATCH_SIZE = 64
+    # Maximum number of batches waiting for main thread.
+    INBOX_SIZE = 256
+    # Interval to drop events which are not used.
+    UNUSED_INFO_INTERVAL = 0.5
+    # Range of intervals to check connection and account information. The
+    # interval grows while nothing comes and never exceeds the old main loop
+    # interval.
+    ACCOUNT_POLL_MIN_INTERVAL = 0.05
+    ACCOUNT_POLL_MAX_INTERVAL = 0.5
+    # Index of last price in a tick, see bitfinex_v2_rest.TradingTicker.
+    LAST_PRICE = 6
+    # Btfxwss queues which are not used by the bot.
+    UNUSED_QUEUES = (
+        'credits', 'offer_new', 'offer_cancel', 'credit_new', 'credit_close',
+        'credit_update', 'positions', 'offer_update', 'order_update',
+        'position_update', 'position_close', 'loan_new', 'loan_close',
+        'loan_update', 'unknown')
+
     def __init__(self, symbols=None, callbacks=None):
         """
         Args:
@@ -108,10 +145,40 @@ class WebSocketApi(object):
 
         self._received_order_snapshot = False
         self._received_wallet_snapshot = False
+        # Batches of (handler, messages) forwarded from Btfxwss queues.
+        self._inbox = queue.Queue(self.INBOX_SIZE)
+        # Set when an order request is sent, since its replies are coming.
+        self._request_sent = threading.Event()
         self._wss = BtfxWss(
             key=config.BFX_API_KEY, secret=config.BFX_API_SECRET)
         self._wss.start()
 
+        self.__forward_account_info([
+            (lambda: self._wss.opened, self.__received_opened),
+            (lambda: self._wss.wallets,
+             lambda x: self.__received_wallets(x[0][1])),
+            (lambda: self._wss.wallet_update,
+             lambda x: self.__received_wallet_update(x[0][1])),
+            (lambda: self._wss.orders,
+             lambda x: self.__received_orders(x[0][1])),
+            (lambda: self._wss.order_new,
+             lambda x: self.__received_order(x[0][1])),
+            (lambda: self._wss.order_cancel,
+             lambda x: self.__received_order(x[0][1])),
+            (lambda: self._wss.notifications,
+             lambda x: self.__received_notification(x[0][1])),
+        ])
+        for symbol in self._tick_symbols:
+            # Only the last price is used, so stale ticks can be dropped.
+            self.__watch(functools.partial(self._wss.tickers, symbol),
+                         functools.partial(self.__received_ticker_message,
+                                           symbol),
+                         latest_only=True)
+
+        thread = threading.Thread(target=self.__drop_unused_info)
+        thread.daemon = True
+        thread.start()
+
     def __connect(self):
         """
         Reset data and subscribe tick data after connect to server.
@@ -125,91 +192,145 @@ class WebSocketApi(object):
             symbol = 't' + pair
             self._wss.subscribe_to_ticker(symbol)
 
-    def __check_system(self):
-        """ Check the connection is established or not. """
-        try:
-            server_q = self._wss.opened
-            while not server_q.empty():
-                server_q.get()
-                self._callbacks['reset']()
-                self.__connect()
-        except KeyError:
-            # KeyError means Btfxwss doesn't get related information yet.
-            # It's fine to pass and check in the next time.
-            pass
-
-    def __check_account_info(self):
-        """ Check account information. """
-        try:
-            wallets_q = self._wss.wallets
-            while not wallets_q.empty():
-                self.__received_wallets(wallets_q.get()[0][1])
-
-            wallet_update_q = self._wss.wallet_update
-            while not wallet_update_q.empty():
-                self.__received_wallet_update(
-                    wallet_update_q.get()[0][1])
-
-            orders_q = self._wss.orders
-            while not orders_q.empty():
-                self.__received_orders(orders_q.get()[0][1])
-
-            order_new_q = self._wss.order_new
-            while not order_new_q.empty():
-                self.__received_order(order_new_q.get()[0][1])
-
-            order_cancel_q = self._wss.order_cancel
-            while not order_cancel_q.empty():
-                self.__received_order(order_cancel_q.get()[0][1])
-
-            notification_q = self._wss.notifications
-            while not notification_q.empty():
-                self.__received_notification(notification_q.get()[0][1])
-        except KeyError:
-            # KeyError means Btfxwss doesn't get related information yet.
-            # It's fine to pass and check in the next time.
-            pass
-
-    def __check_tickers(self):
-        """ Check tick data. """
-        for symbol in self._tick_symbols:
+    @staticmethod
+    def __get_batch(event_q, size):
+        """
+        Get at most size messages from a Btfxwss queue without blocking.
+        qsize() of a multiprocessing queue may count messages which can't be
+        got yet, so stop at queue.Empty instead of trusting it.
+        Args:
+            event_q: The Btfxwss queue
+            size: Maximum number of messages
+        """
+        messages = []
+        for _ in range(size):
             try:
-                trades_q = self._wss.tickers(symbol)
-                while not trades_q.empty():
-                    self.__received_tickers(symbol, trades_q.get()[0])
-            except KeyError:
-                # KeyError means Btfxwss doesn't get related information
-                # yet. It's fine to pass and check in the next time.
-                pass
+                messages.append(event_q.get_nowait())
+            except queue.Empty:
+                break
+        return messages
 
-    def __check_unused_info(self):
+    def __forward_account_info(self, sources):
+        """
+        Forward messages of connection and account queues to the inbox.
+        The queues share one thread and are drained in the given order, so
+        that e.g. a new order is handled before its cancellation no matter
+        how the threads are scheduled.
+        Args:
+            sources: List of (get_queue, handler) in the order to handle
+        """
+        def forward():
+            """ Drain the queues in order and forward their messages """
+            interval = self.ACCOUNT_POLL_MIN_INTERVAL
+            while True:
+                forwarded = False
+                for get_queue, handler in sources:
+                    try:
+                        event_q = get_queue()
+                    except KeyError:
+                        # KeyError means Btfxwss doesn't get related
+                        # information yet. It's fine to pass and check in the
+                        # next time.
+                        continue
+                    # Drain the queue before the next one to keep the order.
+                    while True:
+                        messages = self.__get_batch(event_q,
+                                                    self.MAX_BATCH_SIZE)
+                        if not messages:
+                            break
+                        self._inbox.put((handler, messages))
+                        forwarded = True
+                        if len(messages) < self.MAX_BATCH_SIZE:
+                            break
+                if forwarded:
+                    interval = self.ACCOUNT_POLL_MIN_INTERVAL
+                elif self._request_sent.wait(interval):
+                    self._request_sent.clear()
+                    interval = self.ACCOUNT_POLL_MIN_INTERVAL
+                else:
+                    interval = min(interval * 2,
+                                   self.ACCOUNT_POLL_MAX_INTERVAL)
+
+        thread = threading.Thread(target=forward)
+        thread.daemon = True
+        thread.start()
+
+    def __watch(self, get_queue, handler, latest_only=False):
+        """
+        Forward messages of a Btfxwss queue to the inbox in batches.
+        The queue is looked up once, since Btfxwss keeps it as long as the
+        client.
+        Args:
+            get_queue: Function which returns the Btfxwss queue
+            handler: Function to call with each message of the queue
+            latest_only: Only forward the newest message of each batch
+        """
+        def forward():
+            """ Wait for the queue and forward its messages """
+            interval = self.QUEUE_RETRY_MIN_INTERVAL
+            while True:
+                try:
+                    event_q = get_queue()
+                    break
+                except KeyError:
+                    # KeyError means Btfxwss doesn't get related information
+                    # yet. It's fine to wait and check in the next time.
+                    time.sleep(interval)
+                    interval = min(interval * 2,
+                                   self.QUEUE_RETRY_MAX_INTERVAL)
+            while True:
+                messages = [event_q.get()]
+                newer = self.__get_batch(event_q, self.MAX_BATCH_SIZE - 1)
+                if latest_only:
+                    if newer:
+                        messages = newer[-1:]
+                else:
+                    messages.extend(newer)
+                # Blocks when the main thread falls behind. Messages then
+                # pile up in Btfxwss and are forwarded in larger batches.
+                self._inbox.put((handler, messages))
+
+        thread = threading.Thread(target=forward)
+        thread.daemon = True
+        thread.start()
+
+    def __drop_unused_info(self):
         """
         Websocket may have many events which are not used.
         Just pop it and ignore it. Otherwise, the queue may use too many
         memories.
         """
-        def pop_queue(queue):
+        def pop_queue(event_q):
             """ pop unused queue """
-            while not queue.empty():
-                queue.get()
-
-        try:
-            queues = [
-                self._wss.credits, self._wss.offer_new,
-                self._wss.offer_cancel, self._wss.credit_new,
-                self._wss.credit_close, self._wss.credit_update,
-                self._wss.positions, self._wss.offer_update,
-                self._wss.order_update, self._wss.position_update,
-                self._wss.position_close, self._wss.loan_new,
-                self._wss.loan_close, self._wss.loan_update,
-                self._wss.unknown]
-
-            for queue in queues:
-                pop_queue(queue)
-        except KeyError:
-            # KeyError means Btfxwss doesn't get related information yet.
-            # It's fine to pass and check in the next time.
-            pass
+            while True:
+                try:
+                    event_q.get_nowait()
+                except queue.Empty:
+                    return
+
+        # Unused queues by name, looked up once they exist. Btfxwss creates
+        # each queue once and keeps it across reconnects.
+        unused_queues = {}
+        while True:
+            if len(unused_queues) < len(self.UNUSED_QUEUES):
+                for name in self.UNUSED_QUEUES:
+                    if name in unused_queues:
+                        continue
+                    try:
+                        unused_queues[name] = getattr(self._wss, name)
+                    except KeyError:
+                        # KeyError means Btfxwss doesn't get related
+                        # information yet. It's fine to pass and check in the
+                        # next time.
+                        pass
+            for event_q in unused_queues.values():
+                pop_queue(event_q)
+            time.sleep(self.UNUSED_INFO_INTERVAL)
+
+    def __received_opened(self, unused_message):
+        """ Handle connection established. """
+        self._callbacks['reset']()
+        self.__connect()
 
     def __received_wallets(self, wallets):
         """
@@ -247,6 +368,10 @@ class WebSocketApi(object):
         """
         self._callbacks['process_order'](bitfinex_v2_rest.Order(order))
 
+    def __received_ticker_message(self, pair, message):
+        """ Handle one message of a ticker queue """
+        self.__received_tickers(pair, message[0])
+
     def __received_tickers(self, pair, tickers):
         """
         Handle ticks
@@ -256,8 +381,9 @@ class WebSocketApi(object):
         """
         if isinstance(tickers, list):
             for tick in tickers:
-                self._callbacks['process_tick'](
-                    bitfinex_v2_rest.TradingTicker([pair] + tick))
+                # Ticks are never kept, so pass the last price instead of
+                # building a TradingTicker for each of them.
+                self._callbacks['process_tick'](pair, tick[self.LAST_PRICE])
 
     def __received_notification(self, message):
         """
@@ -297,6 +423,7 @@ class WebSocketApi(object):
                 'hidden': 0
                 }
         self._wss.new_order(**order)
+        self._request_sent.set()
 
     def cancel_order(self, order_id):
         """
@@ -306,13 +433,26 @@ class WebSocketApi(object):
         """
         value = {'id': order_id}
         self._wss.cancel_order(False, **value)
+        self._request_sent.set()
 
-    def check_events(self):
-        """ Check all events from web socket """
-        self.__check_system()
-        self.__check_account_info()
-        self.__check_tickers()
-        self.__check_unused_info()
+    def check_events(self, timeout=None):
+        """
+        Handle all events from web socket.
+        Args:
+            timeout: Seconds to wait for the first event. None means to wait
+                     until an event comes.
+        """
+        try:
+            handler, messages = self._inbox.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            for message in messages:
+                handler(message)
+            try:
+                handler, messages = self._inbox.get_nowait()
+            except queue.Empty:
+                return
 
     def is_received_order_snapshot(self):
         """ Return True if recevied order snapshot """
@@ -334,6 +474,15 @@ class TradeHelper(object):
     def __init__(self):
         pass
 
+    @staticmethod
+    def __get_ratio(cfg, profit):
+        """ Return percent ** profit, cached in config by profit """
+        ratios = cfg['_ratios']
+        ratio = ratios.get(profit)
+        if ratio is None:
+            ratio = ratios[profit] = cfg['percent'] ** profit
+        return ratio
+
     @classmethod
     def get_higher_price(cls, cfg, price, profit):
         """
@@ -343,7 +492,7 @@ class TradeHelper(object):
         if not profit or profit < 0:
             log(LOG_ERROR, 'Profit parameter error: %f' % profit)
             return 0
-        return price * (cfg['percent'] ** profit)
+        return price * cls.__get_ratio(cfg, profit)
 
     @classmethod
     def get_lower_price(cls, cfg, price, profit):
@@ -354,16 +503,16 @@ class TradeHelper(object):
         if not profit or profit < 0:
             log(LOG_ERROR, 'Profit parameter error: %f' % profit)
             return 0
-        return price / (cfg['percent'] ** profit)
+        return price / cls.__get_ratio(cfg, profit)
 
     def get_buy_amount_at_price(self, cfg, price):
         """
         Get coin amount at a given price for buy order.
         Return 0 if error.
         """
-        if cfg['type'].upper() == 'CRYPTO':
+        if cfg['_type'] == TYPE_CRYPTO:
             return cfg['amount']
-        elif cfg['type'].upper() == 'USD':
+        elif cfg['_type'] == TYPE_USD:
             return round(cfg['amount'] / price, self.AMOUNT_DIGIT)
         return 0
 
@@ -378,19 +527,17 @@ class TradeHelper(object):
     @classmethod
     def is_bot_order(cls, cfg, order):
         """ Check the order is bot order not not. """
-        if cfg['type'].upper() == 'CRYPTO':
+        if cfg['_type'] == TYPE_CRYPTO:
             if math.isclose(abs(order.amount_orig), cfg['amount']):
                 return True
-        elif cfg['type'].upper() == 'USD':
+        elif cfg['_type'] == TYPE_USD:
+            # The tolerance is far above float error, no need for Decimal.
+            value = float(order.amount_orig) * order.price
             if order.amount_orig > 0:
-                if math.isclose(order.amount_orig * Decimal(order.price),
-                                cfg['amount'], rel_tol=0.1):
+                if math.isclose(value, cfg['amount'], rel_tol=0.1):
                     return True
             else:
-                expect_sell_amount = cfg['amount'] * (
-                    cfg['percent'] ** cfg['profit'])
-                if math.isclose(-order.amount_orig * Decimal(order.price),
-                                expect_sell_amount, rel_tol=0.1):
+                if math.isclose(-value, cfg['_sell_value'], rel_tol=0.1):
                     return True
         return False
 
@@ -401,23 +548,24 @@ class TradeHelper(object):
         Return MAX_SELL_TIMES means too many
         Return -1 if error
         """
-        balance -= Decimal(cfg['hold'])
-        if balance < Decimal(0):
+        remain_balance = balance - cfg['hold']
+        if remain_balance < 0:
             log(LOG_ERROR, '%s balance is less than hold amount %f' % (
                 pair, cfg['hold']))
             return -1
-        if cfg['type'].upper() == 'CRYPTO':
-            return int(balance / Decimal(cfg['amount']))
-        elif cfg['type'].upper() == 'USD':
-            remain_balance = float(balance)
+        if cfg['_type'] == TYPE_CRYPTO:
+            return int(remain_balance / cfg['amount'])
+        elif cfg['_type'] == TYPE_USD:
             remain_times = 0
-            price = self.get_higher_price(cfg, price, 1)
+            usd_amount = cfg['amount']
+            percent = cfg['percent']
+            price = price * percent
             while remain_times < self.MAX_SELL_TIMES:
-                amount = round(cfg['amount'] / price, self.AMOUNT_DIGIT)
+                amount = round(usd_amount / price, self.AMOUNT_DIGIT)
                 if remain_balance > amount:
                     remain_times += 1
                     remain_balance -= amount
-                    price = self.get_higher_price(cfg, price, 1)
+                    price *= percent
                 else:
                     return remain_times
             return self.MAX_SELL_TIMES
@@ -427,25 +575,27 @@ class TradeHelper(object):
         """ Check the balance reach limit or not """
         if cfg['limit'] == 0:
             return False
-        balance -= Decimal(cfg['hold'])
-        if balance < Decimal(0):
+        remain_balance = balance - cfg['hold']
+        if remain_balance < 0:
             return False
-        if cfg['type'].upper() == 'CRYPTO':
-            if float(balance) >= cfg['amount'] * cfg['limit']:
+        if cfg['_type'] == TYPE_CRYPTO:
+            if remain_balance >= cfg['amount'] * cfg['limit']:
                 return True
-        elif cfg['type'].upper() == 'USD':
-            remain_balance = float(balance)
+        elif cfg['_type'] == TYPE_USD:
             times = 0
-            price = self.get_higher_price(cfg, price, cfg['profit'])
-            while times < cfg['limit']:
-                amount = round(cfg['amount'] / price, self.AMOUNT_DIGIT)
+            limit = cfg['limit']
+            usd_amount = cfg['amount']
+            percent = cfg['percent']
+            price = price * cfg['_percent_profit']
+            while times < limit:
+                amount = round(usd_amount / price, self.AMOUNT_DIGIT)
                 if remain_balance > amount:
                     remain_balance -= amount
                     times += 1
-                    price = self.get_higher_price(cfg, price, 1)
+                    price *= percent
                 else:
                     return False
-            if times >= cfg['limit']:
+            if times >= limit:
                 return True
         return False
 
@@ -461,22 +611,26 @@ class LendBotControl(object):
     def __init__(self, stop_file, bot_config):
         self._lendbot_file = stop_file
         self._lendbot_start = None
-        self._last_move_wallet_timestamp = 0
-        self._minimum_required_balance = Decimal(0)
+        # Cooldowns use time.monotonic() so clock adjustments can't break them.
+        self._last_move_wallet_timestamp = float('-inf')
+        self._minimum_required_balance = 0.0
         self._v1_client = bitfinex_v1_rest.FullApi()
+        # Transfers are REST calls, run them off the main thread. One worker
+        # keeps the v1 nonces in order.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         self.__get_minimum_required_balance(bot_config['symbols'])
 
         setting = bot_config['control_lendbot']
         self._enable = setting['enable']
-        self._target = Decimal(setting['target'])
-        self._start_threshold = Decimal(setting['start_threshold'])
-        self._stop_threshold = Decimal(setting['stop_threshold'])
+        self._target = float(setting['target'])
+        self._start_threshold = float(setting['start_threshold'])
+        self._stop_threshold = float(setting['stop_threshold'])
 
     def check_balance(self, exchange_balance, funding_balance):
         """ Check two wallets to decide to move USD or not """
         if not self._enable:
             return
-        if time.time() - self._last_move_wallet_timestamp < (
+        if time.monotonic() - self._last_move_wallet_timestamp < (
                 self.MOVE_WALLET_COOLDOWN_SEC):
             return
         if (exchange_balance > funding_balance * self._start_threshold) and (
@@ -489,15 +643,17 @@ class LendBotControl(object):
             log(LOG_INFO, 'Exchange: %f, Funding: %f' % (
                 exchange_balance, funding_balance))
             target_amount = (exchange_balance - (
-                self._target * funding_balance)) / (self._target +
-                                                    Decimal(1.0))
+                self._target * funding_balance)) / (self._target + 1.0)
             if exchange_balance - target_amount < (
                     self._minimum_required_balance):
                 target_amount = (
                     exchange_balance - self._minimum_required_balance)
             if target_amount > 0:
-                self.__move_wallet(target_amount)
-                self._last_move_wallet_timestamp = time.time()
+                # Format the amount here, str() of a float may use an
+                # exponent or a long binary tail.
+                self._executor.submit(self.__move_wallet,
+                                      '%.8f' % target_amount)
+                self._last_move_wallet_timestamp = time.monotonic()
         elif exchange_balance < (
                 funding_balance * self._stop_threshold):
             if self._lendbot_start is not False:
@@ -506,20 +662,27 @@ class LendBotControl(object):
             open(self._lendbot_file, 'w').close()
 
     def __move_wallet(self, amount):
-        """ Call v1 REST api to move wallet """
+        """
+        Call v1 REST api to move wallet
+        Args:
+            amount: Amount string of USD to transfer
+        """
         try:
             self._v1_client.transfer_wallet(
                 'USD', amount, 'exchange', 'deposit')
-            log(LOG_INFO, 'Transfer %f from exchange to funding' % amount,
+            log(LOG_INFO, 'Transfer %s from exchange to funding' % amount,
                 EMOJI_MOVE_WALLET)
         except BitfinexClientError:
             log(LOG_ERROR, 'Move wallet error', EMOJI_ERROR)
+        except Exception as e:
+            # Nobody waits for the result, so report any other error here.
+            log(LOG_ERROR, 'Move wallet error: %s' % e, EMOJI_ERROR)
 
     def __get_minimum_required_balance(self, symbols):
         """ Calculate minimum balance to hold orders for each currency """
         for symbol in symbols:
-            if symbols[symbol]['type'].upper() == 'USD':
-                self._minimum_required_balance += Decimal(
+            if symbols[symbol]['_type'] == TYPE_USD:
+                self._minimum_required_balance += (
                     symbols[symbol]['amount'] * self.NUM_ORDERS_TO_PREPARE)
 
 
@@ -527,17 +690,23 @@ class SlackControl(object):
     """ Parse commands from slack daemon """
 
     SLACK_FILE = '.slack_file'
+    PROCESSING_FILE = '.slack_file.processing'
 
     def __init__(self, callback):
         self._callback = callback
 
     def check_files(self):
         """ Check files from slack daemon and validate command """
-        if not os.path.exists(self.SLACK_FILE):
+        # Move the file away before reading it, so commands written while
+        # handling this batch go to a new file instead of being unlinked.
+        try:
+            os.rename(self.SLACK_FILE, self.PROCESSING_FILE)
+        except FileNotFoundError:
             return
-        with open(self.SLACK_FILE, 'r') as slack_fd:
+        with open(self.PROCESSING_FILE, 'r') as slack_fd:
             commands = slack_fd.readlines()
-        commands = [x.strip() for x in commands]
+        os.unlink(self.PROCESSING_FILE)
+        commands = [x.strip() for x in commands if x.strip()]
         for line in commands:
             words = line.split()
             command = words[0]
@@ -550,12 +719,13 @@ class SlackControl(object):
                 log(LOG_ERROR, 'Unsupported command %s' % command)
                 continue
             self._callback(command, args)
-        os.unlink(self.SLACK_FILE)
 
 
 class TradeBot(object):
     """ Trade bot """
 
+    # Interval to run routine checks in main thread.
+    CHECK_INTERVAL_SEC = 0.5
     ORDER_TIMEOUT_SEC = 60
     BUY_CURRENCY_COOLDOWN_SEC = 60
     # This value should be less than TradeHelper.MAX_SELL_TIMES
@@ -570,6 +740,8 @@ class TradeBot(object):
         self.retry_order_in_error = bot_config['retry_in_error']
         self.retry_order_in_timeout = bot_config['retry_in_timeout']
         self._symbols = bot_config['symbols']
+        # Symbols don't change after config is loaded, sort them once.
+        self._sorted_symbols = tuple(sorted(self._symbols))
         self._init_pairs = args['init_pairs']
         self._recover_pairs = args['recover_pairs']
         self._scale_amount = args['scale_amount']
@@ -578,8 +750,12 @@ class TradeBot(object):
         self._orders = {}
         self._num_coins = {}
         self._last_price = {}
-        self._unconfirm_orders = []
+        # Unconfirmed orders by pair, each is
+        # [pair, price, amount, monotonic time, retry_times].
+        self._unconfirm_orders = {}
         self._last_add_timestamp = {}
+        # Pairs whose price or orders changed since cancel_all_buy_orders.
+        self._dirty_pairs = set()
         self._orders_before_disconnect = {}
         self._usd_wallet = {}
         self._received_order_snapshot = False
@@ -587,7 +763,8 @@ class TradeBot(object):
         for symbol in self._symbols:
             self._orders[symbol] = {}
             self._last_price[symbol] = 0
-            self._last_add_timestamp[symbol] = 0
+            self._unconfirm_orders[symbol] = []
+            self._last_add_timestamp[symbol] = float('-inf')
 
         callbacks = {
             'reset': self.reset,
@@ -600,6 +777,13 @@ class TradeBot(object):
         self._helper = TradeHelper()
         self._lendbot = LendBotControl(args['stop_file'], bot_config)
         self._slack = SlackControl(self.receive_slack_command)
+        self._slack_commands = {
+            'INIT': self._slack_init,
+            'RECOVER': self._slack_recover,
+            'ESCAPE': self._slack_escape,
+            'STATUS': self._slack_status,
+            'WALLET': self._slack_wallet,
+        }
 
     def reset(self):
         """ Reset necessary variables when websocket is connected """
@@ -616,15 +800,22 @@ class TradeBot(object):
 
     def run(self):
         """ Routine check in main thread """
+        next_check_time = 0
         while True:
-            self._wsapi.check_events()
+            # Handle events as soon as they come, but still wake up for the
+            # routine checks.
+            self._wsapi.check_events(
+                max(next_check_time - time.monotonic(), 0))
             self.check_order_snapshot()
             self.check_wallet_snapshot()
-            self.check_order_timeout()
+            now = time.monotonic()
+            if now < next_check_time:
+                continue
+            self.check_order_timeout(now)
             self.cancel_all_buy_orders()
             self.check_escape()
             self._slack.check_files()
-            time.sleep(0.5)
+            next_check_time = now + self.CHECK_INTERVAL_SEC
 
     def check_order_snapshot(self):
         """ Check orders during disconnection """
@@ -644,16 +835,20 @@ class TradeBot(object):
 
     def process_wallet(self, wallet):
         """ Process wallet update """
+        # Balances are only compared with float thresholds and config
+        # values, so keep them as float.
+        balance = float(wallet.balance)
         if wallet.currency == 'USD':
-            self._usd_wallet[wallet.wallet_type] = wallet.balance
+            self._usd_wallet[wallet.wallet_type] = balance
             self.check_lendbot()
         if wallet.wallet_type != 'exchange':
             return
-        self._num_coins[wallet.currency] = wallet.balance
+        self._num_coins[wallet.currency] = balance
         pair = wallet.currency + 'USD'
         if pair not in self._symbols:
             return
-        self.check_and_buy_currency(pair, self._symbols[pair], wallet.balance)
+        self.check_and_buy_currency(pair, self._symbols[pair],
+                                    self._last_price[pair], balance)
 
     def process_order(self, order):
         """ Process order update """
@@ -664,25 +859,28 @@ class TradeBot(object):
         if order.status == 'ACTIVE':
             if order.id not in self._orders[pair]:
                 self._orders[pair][order.id] = order
+                self._dirty_pairs.add(pair)
             self.remove_unconfirm_order(pair, order.price, order.amount_orig)
         elif 'PARTIALLY' in order.status:
             if order.id not in self._orders[pair]:
                 self._orders[pair][order.id] = order
+                self._dirty_pairs.add(pair)
             self.remove_unconfirm_order(pair, order.price, order.amount_orig)
             self.handle_executed_order(order, cfg)
         elif order.status == 'CANCELED':
             log(LOG_VERBOSE, 'Cancelled an order, pair: %s, amount: %f, '
                 'price: %f' % (pair, order.amount_orig, order.price))
-            del self._orders[pair][order.id]
+            self._orders[pair].pop(order.id, None)
         elif order.status.startswith('EXECUTED'):
             self.handle_executed_order(order, cfg)
         else:
             log(LOG_ERROR, 'Error order status: %s' % order.status)
 
-    def process_tick(self, ticker):
+    def process_tick(self, pair, last_price):
         """ Process tick update """
-        pair = ticker.symbol
-        self._last_price[pair] = ticker.last_price
+        if last_price != self._last_price[pair]:
+            self._last_price[pair] = last_price
+            self._dirty_pairs.add(pair)
         if self._received_order_snapshot and self._received_wallet_snapshot:
             if pair in self._init_pairs:
                 self.create_init_orders(pair)
@@ -724,38 +922,44 @@ class TradeBot(object):
     def check_order(self, pair, price, amount, check_limit=True):
         """ Check the price and amount of new order exists or not """
         # Order is already in confirmed orders. Ignore it.
-        for _, order in self._orders[pair].items():
-            if (math.isclose(order.amount_orig, amount, rel_tol=0.01) and
-                    math.isclose(order.price, price, rel_tol=0.001)):
+        # Orders of a pair mostly share the amount but never the price, so
+        # compare the price first to reject them early.
+        for order in self._orders[pair].values():
+            if (math.isclose(order.price, price, rel_tol=0.001) and
+                    math.isclose(order.amount_orig, amount, rel_tol=0.01)):
                 return True
         # Order is already in unconfirmed orders. Ignore it.
-        for order in self._unconfirm_orders:
-            if (order[0] == pair and
-                    math.isclose(order[1], price, rel_tol=0.001) and
+        for order in self._unconfirm_orders[pair]:
+            if (math.isclose(order[1], price, rel_tol=0.001) and
                     math.isclose(order[2], amount, rel_tol=0.01)):
                 return True
         # check the value of coins reach the upper limit or not
-        if check_limit and amount > 0 and self._helper.is_reach_limit(
-                self._symbols[pair], self._last_price[pair],
-                self._num_coins[pair[:3]]):
-            log(LOG_INFO, 'Pair %s reach limit' % pair, EMOJI_LIMIT)
-            return True
+        if check_limit and amount > 0:
+            cfg = self._symbols[pair]
+            if self._helper.is_reach_limit(cfg, self._last_price[pair],
+                                           self._num_coins[cfg['_base']]):
+                log(LOG_INFO, 'Pair %s reach limit' % pair, EMOJI_LIMIT)
+                return True
         return False
 
-    def check_order_timeout(self):
+    def check_order_timeout(self, now):
         """ Check unconfirmed orders is timeout or not """
         if not self._received_order_snapshot:
             return
-        temp_orders = list(self._unconfirm_orders)
         retry_orders = []
-        for order in self._unconfirm_orders:
-            if (time.time() - order[3]) > self.ORDER_TIMEOUT_SEC:
-                log(LOG_ERROR, 'Order %s with amount: %f, price: %f timeout. '
-                    'Need to retry, retry times: %d' % (
-                        order[0], order[2], order[1], order[4]))
-                temp_orders.remove(order)
-                retry_orders.append(order)
-        self._unconfirm_orders = temp_orders
+        for pair, orders in self._unconfirm_orders.items():
+            if not orders:
+                continue
+            keep_orders = []
+            for order in orders:
+                if (now - order[3]) > self.ORDER_TIMEOUT_SEC:
+                    log(LOG_ERROR, 'Order %s with amount: %f, price: %f '
+                        'timeout. Need to retry, retry times: %d' % (
+                            order[0], order[2], order[1], order[4]))
+                    retry_orders.append(order)
+                else:
+                    keep_orders.append(order)
+            self._unconfirm_orders[pair] = keep_orders
         if self.retry_order_in_timeout:
             for order in retry_orders:
                 if order[4] > 0:  # retry
@@ -763,22 +967,23 @@ class TradeBot(object):
 
     def remove_unconfirm_order(self, pair, price, amount):
         """ Remove an order from unconfirmed list """
-        temp_orders = self._unconfirm_orders
-        retry_times = 0
-        real_price = price
-        for order in self._unconfirm_orders:
-            if (order[0] == pair and
-                    math.isclose(order[2], amount, rel_tol=0.01)):
-                if (math.isclose(order[1], price, rel_tol=0.01) or
-                        order[1] == 0):
-                    retry_times = order[4]
-                    # For market order, the price should be 0
-                    real_price = order[1]
-                    temp_orders.remove(order)
-        self._unconfirm_orders = temp_orders
-        return (retry_times, real_price)
-
-    def check_and_buy_currency(self, pair, cfg, balance):
+        keep_orders = []
+        matched = None
+        for order in self._unconfirm_orders.get(pair, ()):
+            # For market order, the price should be 0
+            if (matched is None and
+                    math.isclose(order[2], amount, rel_tol=0.01) and
+                    (math.isclose(order[1], price, rel_tol=0.01) or
+                     order[1] == 0)):
+                matched = order
+            else:
+                keep_orders.append(order)
+        if matched is None:
+            return (0, price)
+        self._unconfirm_orders[pair] = keep_orders
+        return (matched[4], matched[1])
+
+    def check_and_buy_currency(self, pair, cfg, price, balance):
         """
         Check the number of orders to sell. If the number is less than expected
         number, buy two orders at market price.
@@ -786,7 +991,6 @@ class TradeBot(object):
         Return 0 if the number of orders is enough
         Return 1 if the number of orders is not enough, should chase currency
         """
-        price = self._last_price[pair]
         if price == 0:
             return -1
         remain_times = self._helper.get_remain_times(pair, cfg, price, balance)
@@ -794,13 +998,14 @@ class TradeBot(object):
             return -1
         if remain_times <= self.NUM_ORDERS_TO_HOLD:
             log(LOG_INFO, 'Pair %s is not enough: %f' % (pair, balance))
-            allow_buy = time.time() - self._last_add_timestamp[pair] > (
+            now = time.monotonic()
+            allow_buy = now - self._last_add_timestamp[pair] > (
                 self.BUY_CURRENCY_COOLDOWN_SEC)
             if self.buy_currency and allow_buy:
                 units = self.NUM_ORDERS_TO_HOLD - remain_times + 2
                 amount = self._helper.get_buy_amount_at_price(cfg, price)
                 self.new_order(pair, 0, amount * units)
-                self._last_add_timestamp[pair] = time.time()
+                self._last_add_timestamp[pair] = now
             return 1
         return 0
 
@@ -863,8 +1068,8 @@ class TradeBot(object):
         """ Create an new order """
         if retry_times is None:
             retry_times = self.NO_BALANCE_RETRY_TIMES
-        self._unconfirm_orders.append(
-            [pair, price, amount, time.time(), retry_times])
+        self._unconfirm_orders[pair].append(
+            [pair, price, amount, time.monotonic(), retry_times])
         self._wsapi.new_order(pair, price, amount)
         log(LOG_VERBOSE, 'Create a new %s order with amount: %f, price: %f' %
             (pair, amount, price))
@@ -875,22 +1080,27 @@ class TradeBot(object):
 
     def cancel_all_buy_orders(self):
         """ Remove buy orders which price is too far from current price """
-        cancel_orders = []
-        for symbol, orders in self._orders.items():
-            if self._last_price[symbol] == 0:
+        is_bot_order = self._helper.is_bot_order
+        # Only pairs with a new price or new orders can have new orders to
+        # cancel.
+        dirty_pairs = self._dirty_pairs
+        self._dirty_pairs = set()
+        for symbol in dirty_pairs:
+            orders = self._orders[symbol]
+            last_price = self._last_price[symbol]
+            if last_price == 0:
                 continue
             cfg = self._symbols[symbol]
-            cancel_price = self._helper.get_lower_price(
-                cfg, self._last_price[symbol], 5)
-            for _, order in orders.items():
-                if not self._helper.is_bot_order(cfg, order):
-                    continue
-                if order.amount_orig > 0 and order.price < cancel_price:
-                    cancel_orders.append(order)
-        for order in cancel_orders:
-            self.cancel_order(order)
-            symbol = order.symbol[1:]
-            del self._orders[symbol][order.id]
+            cancel_price = self._helper.get_lower_price(cfg, last_price, 5)
+            # Most orders are sell orders or near the current price. Filter
+            # them out before the more expensive is_bot_order.
+            cancel_orders = [
+                order for order in orders.values()
+                if order.amount_orig > 0 and order.price < cancel_price and
+                is_bot_order(cfg, order)]
+            for order in cancel_orders:
+                self.cancel_order(order)
+                del orders[order.id]
 
     def cancel_all_orders(self, pair):
         """ Cancel all orders according to the pair """
@@ -903,30 +1113,25 @@ class TradeBot(object):
         self._orders[pair] = {}
 
         cfg = self._symbols[pair]
-        currency = pair[:3]
-        num_coins = 0
-        if currency in self._num_coins:
-            num_coins = self._num_coins[currency]
-        ret = self.check_and_buy_currency(pair, cfg, num_coins)
+        price = self._last_price[pair]
+        num_coins = self._num_coins.get(cfg['_base'], 0)
+        ret = self.check_and_buy_currency(pair, cfg, price, num_coins)
         if ret == 1:
             log(LOG_INFO, 'Wait for currency ready')
             return
         elif ret == -1:
             del self._init_pairs[pair]
             return
-        self.set_orders_by_price(pair, cfg, self._last_price[pair], 'BUY')
+        self.set_orders_by_price(pair, cfg, price, 'BUY')
 
         log(LOG_INFO, 'Already initialized %s' % pair)
         del self._init_pairs[pair]
 
     def create_recover_orders(self, pair):
         """ Create recover buy order of a pair """
-        lowest_sell_price = 0
-        for _, order in self._orders[pair].items():
-            if order.amount_orig > 0:
-                continue
-            if lowest_sell_price == 0 or order.price < lowest_sell_price:
-                lowest_sell_price = order.price
+        lowest_sell_price = min(
+            (order.price for order in self._orders[pair].values()
+             if order.amount_orig < 0), default=0)
 
         cfg = self._symbols[pair]
         buy_price = self._helper.get_lower_price(
@@ -949,7 +1154,7 @@ class TradeBot(object):
             log(LOG_ERROR, 'You do not have %s, run --init instead' % pair)
             del self._scale_amount[pair]
             return
-        num_coins = float(self._num_coins[pair[:3]]) - cfg['hold']
+        num_coins = self._num_coins[pair[:3]] - cfg['hold']
         if num_coins <= 0:
             log(LOG_ERROR, '%s balance is less than hold amount %f' % (
                 pair, cfg['hold']))
@@ -969,37 +1174,35 @@ class TradeBot(object):
 
     def view_status(self):
         """ Print how many orders should be added when bot stop """
-        msg = ''
-        active_pairs = 'Active:'
-        for pair in sorted(self._symbols):
+        miss_lines = []
+        active_pairs = ['Active:']
+        for pair in self._sorted_symbols:
             if not self._last_price[pair]:
                 continue
-            lowest_price = 0
-            no_miss = False
-            for _, order in self._orders[pair].items():
-                if order.amount_orig > 0:
-                    no_miss = True
-                    break
-                if lowest_price == 0 or order.price < lowest_price:
-                    lowest_price = order.price
+            orders = self._orders[pair].values()
+            # Any buy order means the price is still inside the ladder.
+            no_miss = any(order.amount_orig > 0 for order in orders)
 
             if not no_miss:
+                lowest_price = min((order.price for order in orders),
+                                   default=0)
                 cfg = self._symbols[pair]
                 current_price = self._last_price[pair]
                 miss_price = self._helper.get_lower_price(
                     cfg, lowest_price, cfg['profit'] + 1)
                 miss_times = 1
-                while miss_price > current_price:
-                    miss_times += 1
-                    miss_price = self._helper.get_lower_price(
-                        cfg, miss_price, 1)
-                msg += '%s miss %d, gap %.3f, now %.3f\n' % (
+                if miss_price > current_price:
+                    # Each missed order is one percent step lower, count the
+                    # steps down to current price directly.
+                    miss_times += math.ceil(
+                        math.log(miss_price / current_price) /
+                        math.log(cfg['percent']))
+                miss_lines.append('%s miss %d, gap %.3f, now %.3f\n' % (
                     pair[:3], miss_times, lowest_price - current_price,
-                    current_price)
+                    current_price))
             else:
-                active_pairs += ' %s' % pair[:3]
-        msg = active_pairs + '\n' + msg
-        log(LOG_INFO, msg)
+                active_pairs.append(pair[:3])
+        log(LOG_INFO, ' '.join(active_pairs) + '\n' + ''.join(miss_lines))
 
     def check_orders_during_disconnect(self):
         """ Check executed orders during disconnection """
@@ -1008,13 +1211,16 @@ class TradeBot(object):
             if symbol not in self._symbols:
                 continue
             cfg = self._symbols[symbol]
-            for order_id, order in orders.items():
-                if order_id not in self._orders[symbol]:
-                    has_executed_order = True
-                    log(LOG_INFO, 'Missing an order, pair: %s, amount: %f, '
-                        'price: %f' % (symbol, order.amount_orig, order.price),
-                        EMOJI_DISCONNECT)
-                    self.handle_executed_order(order, cfg, False)
+            # Orders which disappeared during disconnection were executed.
+            missing_ids = orders.keys() - self._orders[symbol].keys()
+            # Order ids grow over time, keep handling them in order.
+            for order_id in sorted(missing_ids):
+                order = orders[order_id]
+                has_executed_order = True
+                log(LOG_INFO, 'Missing an order, pair: %s, amount: %f, '
+                    'price: %f' % (symbol, order.amount_orig, order.price),
+                    EMOJI_DISCONNECT)
+                self.handle_executed_order(order, cfg, False)
         if not has_executed_order:
             log(LOG_INFO, 'No executed orders during disconnection',
                 EMOJI_DISCONNECT)
@@ -1049,22 +1255,35 @@ class TradeBot(object):
 
     def receive_slack_command(self, command, args):
         """ Callback function to execute slack command """
-        if command.upper() == 'INIT':
-            log(LOG_INFO, 'Received init command ' + str(args))
-            self._init_pairs.update(args)
-        elif command.upper() == 'RECOVER':
-            log(LOG_INFO, 'Received recover command ' + str(args))
-            self._recover_pairs.update(args)
-        elif command.upper() == 'ESCAPE':
-            log(LOG_INFO, 'Received escape command ' + str(args))
-#             self.check_escape()
-        elif command.upper() == 'STATUS':
-            log(LOG_INFO, 'Received status command ' + str(args))
-            self.view_status()
-        elif command.upper() == 'WALLET':
-            log(LOG_INFO, 'Received wallet command ' + str(args))
-            log(LOG_INFO, 'Exchange: %f, Funding: %f' % (
-                self._usd_wallet['exchange'], self._usd_wallet['funding']))
+        handler = self._slack_commands.get(command.upper())
+        if handler:
+            handler(args)
+
+    def _slack_init(self, args):
+        """ Handle slack init command """
+        log(LOG_INFO, 'Received init command ' + str(args))
+        self._init_pairs.update(args)
+
+    def _slack_recover(self, args):
+        """ Handle slack recover command """
+        log(LOG_INFO, 'Received recover command ' + str(args))
+        self._recover_pairs.update(args)
+
+    def _slack_escape(self, args):
+        """ Handle slack escape command """
+        log(LOG_INFO, 'Received escape command ' + str(args))
+#         self.check_escape()
+
+    def _slack_status(self, args):
+        """ Handle slack status command """
+        log(LOG_INFO, 'Received status command ' + str(args))
+        self.view_status()
+
+    def _slack_wallet(self, args):
+        """ Handle slack wallet command """
+        log(LOG_INFO, 'Received wallet command ' + str(args))
+        log(LOG_INFO, 'Exchange: %f, Funding: %f' % (
+            self._usd_wallet['exchange'], self._usd_wallet['funding']))
 
 
 def check_pairs_in_config(pairs_str):
@@ -1110,9 +1329,28 @@ def check_config():
             print('Pair %s miss type setting' % symbol)
             return False
         symbol_type = config.TRADE_HBOT_CONFIG['symbols'][symbol]['type']
-        if symbol_type.upper() not in ['USD', 'CRYPTO']:
+        if symbol_type.upper() not in PAIR_TYPES:
             print('Pair %s has error config type %s' % (symbol, symbol_type))
             return False
+        cfg = config.TRADE_HBOT_CONFIG['symbols'][symbol]
+        cfg['_type'] = PAIR_TYPES[symbol_type.upper()]
+        cfg['_base'] = symbol[:3]
+        for key in ('amount', 'percent', 'hold'):
+            if not math.isfinite(cfg[key]):
+                print('Pair %s has error config %s %s' % (
+                    symbol, key, cfg[key]))
+                return False
+        if cfg['profit'] <= 0:
+            print('Pair %s has error config profit %s' % (
+                symbol, cfg['profit']))
+            return False
+        # Ratio between buy and sell price, used on every price calculation.
+        cfg['_percent_profit'] = cfg['percent'] ** cfg['profit']
+        # percent ** profit by profit, filled by TradeHelper on demand.
+        cfg['_ratios'] = {1: cfg['percent'],
+                          cfg['profit']: cfg['_percent_profit']}
+        # Expected USD value of a bot sell order.
+        cfg['_sell_value'] = cfg['amount'] * cfg['_percent_profit']
 
     if 'control_lendbot' in config.TRADE_HBOT_CONFIG:
         lendbot_setting = config.TRADE_HBOT_CONFIG['control_lendbot']
@@ -1177,7 +1415,11 @@ def main():
     args['stop_file'] = opts.stop_file
     args['escape'] = opts.escape
     bot = TradeBot(config.TRADE_HBOT_CONFIG, args)
-    bot.run()
+    try:
+        bot.run()
+    finally:
+        if SLACK:
+            SLACK.flush()
 
 
 if __name__ == '__main__':
@@ -1,21 +1,20 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
 
 import argparse
-import datetime
 import decimal
 import logging
 import os
 import pprint
+import random
 import sqlite3
 import time
 
-from slacker import Slacker
-
 from alec import config
 from alec import database_utils
+from alec import slack_utils
 from alec.api import BitfinexClientError
 from alec.api import bitfinex_v1_rest
 from alec.api import bitfinex_v2_rest
@@ -33,15 +32,18 @@ FIAT = 'usd'
 MAX_CANCEL_ORDER_RETRIES = 10
 MAX_ORDER_STATUS_RETRIES = 30
 
-RATE_LIMIT_TIME = 120
+# Sleep time after hitting rate limit. Doubled on each consecutive hit.
+RATE_LIMIT_MIN_TIME = 15
+RATE_LIMIT_MAX_TIME = 240
 
-slack = Slacker(config.SLACK_TOKEN) if config.SLACK_ENABLE else None
+# Created by main(), so importing this module doesn't start the poster.
+slack = None
 logger = logging.getLogger(__name__)
 
 
 def log(text, exception=False, side=None, need_coin=False, need_fiat=False,
         admin=False, warning=False, is_market=False):
-    """Log to stdout and slack if enabled.
+    """Log to the logger and slack if enabled.
 
     Args:
       text: The content to log.
@@ -54,7 +56,7 @@ def log(text, exception=False, side=None, need_coin=False, need_fiat=False,
       is_market: Show market order sign.
 
     """
-    print(str(datetime.datetime.now()) + '\t' + text)
+    logger.info(text)
     if slack:
         if exception:
             text = ':rotating_light: Exception:' + text
@@ -73,8 +75,7 @@ def log(text, exception=False, side=None, need_coin=False, need_fiat=False,
         if admin:
             text = '@' + config.SLACK_ADMIN + ' ' + text
 
-        slack.chat.post_message(config.SLACK_CHANNEL, text,
-                                as_user=True, link_names=True)
+        slack.post_message(text, as_user=True, link_names=True)
 
 
 class TradeBotError(Exception):
@@ -113,22 +114,50 @@ class TradeBot(object):
         self._last_time_post_result = time.time()
         # Watchlist for market orders.
         self._watched_market_orders = {}
+        # Last prices fetched in this iteration, from symbol to price.
+        self._price_cache = {}
+        # Rows of executed_orders and ids of old_executed_orders to be stored
+        # together at the end of this iteration.
+        self._executed_rows = []
+        self._executed_ids = []
 
     def _normalize_target(self):
         """Normalize some configs."""
-        for k, v in self._targets.iteritems():
+        for k, v in self._targets.items():
             # Normalize to Decimal.
             v['unit'] = decimal.Decimal(v['unit'])
             v['step'] = decimal.Decimal(v['step'])
+            # Price ratios of paired orders to the executed price.
+            v['sell_ratio'] = 1 + v['step']
+            v['buy_ratio'] = 1 - v['step']
             # Remove fiat like 'USD' in target key to get currency for wallet.
             # E.g., target key 'ETHUSD', currency 'eth'
             assert k[-3:].lower() == FIAT and len(k) > 3
             v['currency'] = k[:-3].lower()
 
     def _get_last_price(self, symbol):
-        """Gets latest price of a symbol."""
-        ticker = self._v1_client.ticker(symbol)
-        return ticker['last_price']
+        """Gets latest price of a symbol.
+
+        Prices of all targets are fetched together in one request and cached
+        until the next iteration of the main loop.
+
+        """
+        if symbol not in self._price_cache and symbol in self._targets:
+            self._fetch_target_prices()
+        if symbol not in self._price_cache:
+            ticker = self._v1_client.ticker(symbol)
+            self._price_cache[symbol] = ticker['last_price']
+        return self._price_cache[symbol]
+
+    def _fetch_target_prices(self):
+        """Fetches last prices of all targets into the price cache."""
+        # From v2 symbol, e.g. 'tETHUSD', to target symbol.
+        symbols = {'t' + symbol.upper(): symbol for symbol in self._targets}
+        for ticker in self._v2_client.tickers(*symbols):
+            # v2 prices are floats. Cast to str to get the approximated
+            # decimal like bitfinex_v2_rest does.
+            self._price_cache[symbols[ticker.symbol]] = decimal.Decimal(
+                str(ticker.last_price))
 
     def _get_account_info(self, print_log=False):
         """Shows balances and value and get total value.
@@ -148,7 +177,7 @@ class TradeBot(object):
                                                  fiat_info['amount'],
                                                  fiat_info['available']))
         total_value = fiat_info['amount']
-        for k, v in self._targets.iteritems():
+        for k, v in self._targets.items():
             coin_info = self._get_wallet_info(currency=v['currency'],
                                               balances=balances)
             coin_amount = coin_info['amount']
@@ -168,31 +197,44 @@ class TradeBot(object):
 
     def run(self):
         """Runs main strategy in a loop."""
+        rate_limit_time = RATE_LIMIT_MIN_TIME
         while True:
             if os.path.exists(DISABLE_JBOT_TAG):
                 log('Disabled by slack')
-                logger.info('Disabled by slack')
                 time.sleep(self.NORMAL_INTERVAL)
                 continue
 
             try:
-                logger.info('=' * 20)
                 log('=' * 20)
 
+                # Fetch fresh prices in each iteration.
+                self._price_cache.clear()
+
                 # Post result in a rough interval.
                 if (time.time() - self._last_time_post_result >
                     self.POST_RESULT_INTERVAL):
                     self._post_result_to_slack()
                     self._last_time_post_result = time.time()
 
-                sleep_time = self._trade_strategy()
+                try:
+                    sleep_time = self._trade_strategy()
+                finally:
+                    self._save_executed_orders()
+                rate_limit_time = RATE_LIMIT_MIN_TIME
                 time.sleep(sleep_time)
 
             except BitfinexClientError as e:
                 log('Bitfinex: ' + str(e), exception=True)
                 if 'ERR_RATE_LIMIT' in str(e):
-                    log('Bitfinex: sleep some time for rate limit')
-                    time.sleep(RATE_LIMIT_TIME)
+                    # Back off exponentially with jitter, so a short rate
+                    # limit doesn't cost minutes and repeated ones are not
+                    # retried in lockstep.
+                    sleep_time = rate_limit_time + random.random()
+                    log('Bitfinex: sleep %.1f seconds for rate limit' %
+                        sleep_time)
+                    time.sleep(sleep_time)
+                    rate_limit_time = min(rate_limit_time * 2,
+                                          RATE_LIMIT_MAX_TIME)
                     continue
                 raise
             except Exception as e:
@@ -200,15 +242,20 @@ class TradeBot(object):
                 raise
 
     def _get_balances(self):
-        """Gets balances from bitfinex api."""
-        return self._v1_client.balances()
+        """Gets balances from bitfinex api.
+
+        Returns:
+            A dict from (currency in lower case, wallet type) to wallet.
+
+        """
+        return {(wallet['currency'].lower(), wallet['type']): wallet
+                for wallet in self._v1_client.balances()}
 
     def _get_wallet_info(self, currency, balances):
         """Gets one exchange wallet from balances."""
-        for wallet in balances:
-            if wallet['currency'].lower() == currency.lower() and (
-                    wallet['type'] == 'exchange'):
-                return wallet
+        wallet = balances.get((currency.lower(), 'exchange'))
+        if wallet is not None:
+            return wallet
         raise TradeBotError(
                 'No wallet information for %s. You have never used this '
                 'wallet for this coin. Put some coins into this wallet first' %
@@ -217,12 +264,11 @@ class TradeBot(object):
     def _should_watch_this_order(self, order):
         """Checks if this order matches the unit set in targets."""
         # Check symbol.
-        symbol = order['symbol']
-        if symbol not in self._targets:
+        target_config = self._targets.get(order['symbol'])
+        if target_config is None:
             return False
 
         # Check amount.
-        target_config = self._targets[symbol]
         if order['original_amount'] != target_config['unit']:
             return False
 
@@ -238,14 +284,13 @@ class TradeBot(object):
 
         return True
 
-    def _get_live_order_ids(self):
-        """Gets a list of live order ids."""
-        orders = self._v1_client.orders()
-        return [order['id'] for order in orders]
+    def _check_new_watched_orders(self, orders):
+        """Finds any live order that should be put into the watchlist.
 
-    def _check_new_watched_orders(self):
-        """Finds any live order that should be put into the watchlist."""
-        orders = self._v1_client.orders()
+        Args:
+            orders: Live orders returned by the orders API.
+
+        """
         for order in orders:
             order_id = order['id']
             # Already being watched, still, the price might be changed by
@@ -283,9 +328,12 @@ class TradeBot(object):
         # No matter the cancel order request succeed or not, store it
         # to db.
         self._save_should_be_cancelled_order(id)
+        self._send_cancel_order(id)
 
+    def _send_cancel_order(self, id):
+        """Sends the request to cancel one order, retrying some failures."""
         # Retry some times to cancel an order.
-        for i in xrange(MAX_CANCEL_ORDER_RETRIES):
+        for i in range(MAX_CANCEL_ORDER_RETRIES):
             try:
                 self._v1_client.cancel_order(id)
             except BitfinexClientError as e:
@@ -312,7 +360,7 @@ class TradeBot(object):
             None otherwise.
 
         """
-        for i in xrange(MAX_ORDER_STATUS_RETRIES):
+        for i in range(MAX_ORDER_STATUS_RETRIES):
             try:
                 ret = self._v1_client.order_status(id=id)
             except BitfinexClientError as e:
@@ -332,26 +380,26 @@ class TradeBot(object):
         logger.warning('Still can not find order status for %s', id)
         return None
 
-    def _check_watched_orders(self):
+    def _check_watched_orders(self, orders):
         """Queries order status and react to executed orders.
 
         For every executed order in watchlist, create one buy and one sell
         orders for it. Cancel the paired order that was created with it.
 
-        """
-        # This balances will be reused for this iteration.
-        balances = self._get_balances()
-
-        # Check live orders in one API call to save rate limit.
-        live_orders = self._get_live_order_ids()
-
-        # Put watched ids in a list because we will remove items in the
-        # dict in for loop. Use list since keys() returns an iterator
-        # in Python 3.
-        for id in list(self._watched_orders.keys()):
-            if id in live_orders:
-                continue
+        Args:
+            orders: Live orders fetched in this iteration.
 
+        """
+        # Only fetched when an order was executed. Reused for the rest of
+        # this loop.
+        balances = None
+        live_orders = set(order['id'] for order in orders)
+        watched_orders = self._watched_orders
+        paired_orders = self._paired_orders
+
+        # Put watched ids which are not live in a list because we will remove
+        # items in the dict in for loop.
+        for id in [id for id in watched_orders if id not in live_orders]:
             # Checks if it is an old executed order.
             if self._is_old_executed_order(id):
                 continue
@@ -364,14 +412,13 @@ class TradeBot(object):
 
             # Cancelled, so remove it from watchlist.
             if self._order_was_cancelled(order_status):
-                self._watched_orders.pop(id)
+                watched_orders.pop(id)
 
                 # The paired order of this cancelled order should
                 # not be paired with this cancelled order anymore.
-                if id in self._paired_orders:
-                    another_id = self._paired_orders[id]
-                    self._paired_orders.pop(id)
-                    self._paired_orders.pop(another_id)
+                another_id = paired_orders.pop(id, None)
+                if another_id is not None:
+                    paired_orders.pop(another_id)
 
             # Executed. Record and react on it.
             elif self._order_was_executed(order_status):
@@ -379,16 +426,15 @@ class TradeBot(object):
                 # Store the executed order.
                 self._record_executed(order_status)
                 # Remove it from watchlist.
-                self._watched_orders.pop(id)
+                watched_orders.pop(id)
 
                 # Cancel the order of another direction which was created with
                 # order. This is to keep number of orders remain constant.
                 # Execute 1  -> cancel 1, create 1 buy, create 1 sell.
-                if id in self._paired_orders:
-                    another_id = self._paired_orders[id]
+                another_id = paired_orders.pop(id, None)
+                if another_id is not None:
+                    paired_orders.pop(another_id)
                     self._cancel_order(another_id)
-                    self._paired_orders.pop(id)
-                    self._paired_orders.pop(another_id)
 
                 # If an order that should be cancelled was somehow left alive,
                 # and got executed, do not create new order for it.
@@ -398,6 +444,8 @@ class TradeBot(object):
                         warning=True)
                     continue
 
+                if balances is None:
+                    balances = self._get_balances()
                 self._action_to_executed_order(order_status, balances=balances)
 
     def _record_executed(self, order_status):
@@ -417,12 +465,13 @@ class TradeBot(object):
         if not self._db:
             return
 
-        # Insert a row in old_executed_orders.
-        self._save_old_executed_order(id)
-
-        # Insert a row of data to executed_orders table.
-        self._db.execute("INSERT INTO executed_orders VALUES (?,?,?,?,?)",
-                         (timestamp, symbol, side, float(amount), float(price)))
+        # Queue a row of data to executed_orders table and the id to
+        # old_executed_orders table. Both are stored in one transaction by
+        # _save_executed_orders, so an order is never marked old without
+        # being recorded.
+        self._executed_rows.append(
+            (timestamp, symbol, side, float(amount), float(price)))
+        self._executed_ids.append((id,))
 
     def _action_to_executed_order(self, order_status, balances):
         """Does some actions based on an executed order."""
@@ -454,30 +503,36 @@ class TradeBot(object):
 
         sell_order_id, buy_order_id = None, None
 
-        # Set a sell order with higher price and the same amount.
-        sell_target_ratio = decimal.Decimal(1.0) + target_config['step']
-        sell_price = mid_price * sell_target_ratio
+        # Set a sell order with higher price and a buy order with less price,
+        # both with the same amount.
+        sell_price = mid_price * target_config['sell_ratio']
+        buy_price = mid_price * target_config['buy_ratio']
+
+        # Try to place both orders in one request. If that fails, place them
+        # one by one so the side that can be placed still is.
+        statuses = self._create_new_paired_limit_orders(
+                symbol=symbol, amount=amount, sell_price=sell_price,
+                buy_price=buy_price)
+        if statuses:
+            sell_status, buy_status = statuses
+        else:
+            sell_status = self._create_new_limit_order(
+                    symbol=symbol, price=sell_price, amount=amount, side='sell')
+            buy_status = self._create_new_limit_order(
+                    symbol=symbol, price=buy_price, amount=amount, side='buy')
 
-        status = self._create_new_limit_order(
-                symbol=symbol, price=sell_price, amount=amount, side='sell')
-        if status:
-            sell_order_id = status['id']
+        if sell_status:
+            sell_order_id = sell_status['id']
             # Add the new order to watchlist.
-            self._watched_orders[sell_order_id] = status
+            self._watched_orders[sell_order_id] = sell_status
         else:
             log('Not enough %s to create a sell order @ %s' %
                 (target_config['currency'], sell_price), need_coin=True)
 
-        # Set a buy order with less price and the same amount.
-        buy_target_ratio = decimal.Decimal(1.0) - target_config['step']
-        buy_price = mid_price * buy_target_ratio
-
-        status = self._create_new_limit_order(
-                symbol=symbol, price=buy_price, amount=amount, side='buy')
-        if status:
-            buy_order_id = status['id']
+        if buy_status:
+            buy_order_id = buy_status['id']
             # Add the new order to watchlist.
-            self._watched_orders[buy_order_id] = status
+            self._watched_orders[buy_order_id] = buy_status
         else:
             log('Not enough %s to create a buy order @ %s' %
                 (FIAT, buy_price), need_fiat=True)
@@ -512,6 +567,38 @@ class TradeBot(object):
 
         return status
 
+    def _create_new_paired_limit_orders(self, symbol, amount, sell_price,
+                                        buy_price):
+        """Creates a sell and a buy limit order in one request.
+
+        Returns: A tuple of sell and buy order status on success. Status of
+                 an order which was not created is None. None on failure
+                 because of not enough coin/fiat in exchange wallet.
+
+        """
+        try:
+            result = self._v1_client.new_multiple_limit_orders([
+                {'symbol': symbol, 'amount': amount, 'price': sell_price,
+                 'side': 'sell'},
+                {'symbol': symbol, 'amount': amount, 'price': buy_price,
+                 'side': 'buy'},
+            ])
+        except BitfinexClientError as e:
+            # Not enough fiat or coin in exchange wallet.
+            if 'Invalid order: not enough' in str(e):
+                logger.warning('Invalid paired orders: %s', str(e))
+                return None
+            else:
+                raise
+
+        statuses = {}
+        for status in result['order_ids']:
+            logger.info('New order: %s: %s %s: %s @ %s', status['id'],
+                        status['side'], symbol, amount, status['price'])
+            statuses[status['side']] = status
+
+        return statuses.get('sell'), statuses.get('buy')
+
     def _create_new_market_order(self, symbol, amount, price, side):
         """Creates a new market order and returns the order status.
 
@@ -542,13 +629,13 @@ class TradeBot(object):
 
     def _format_order_str(self, prefix, order_status):
         """Formats a string to show order."""
-        return '%s: Order %s: %s %s: %s @ %s' % (
+        return '%s: Order %11d: %-6s %-10s: %-8s @ %-8s' % (
                     prefix,
-                    '{:11d}'.format(order_status['id']),
-                    '{:6s}'.format(order_status['side']),
-                    '{:10s}'.format(order_status['symbol']),
-                    '{:8s}'.format(str(order_status['original_amount'])),
-                    '{:8s}'.format(str(order_status['price'])))
+                    order_status['id'],
+                    order_status['side'],
+                    order_status['symbol'],
+                    order_status['original_amount'],
+                    order_status['price'])
 
     def _log_one_live_order(self, prefix, order_status):
         """Logs one live order status."""
@@ -557,7 +644,9 @@ class TradeBot(object):
 
     def _log_watched_orders(self):
         """Logs the summary of watched orders and their paired orders."""
-        for id, status in self._watched_orders.iteritems():
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        for id, status in self._watched_orders.items():
             self._log_one_live_order('Watching ', status)
             if id in self._paired_orders:
                 paired_order_id = self._paired_orders[id]
@@ -572,25 +661,28 @@ class TradeBot(object):
 
         """
         # Checks if there is any target that does not have a order.
-        symbols_with_orders = set()
-        for id, status in self._watched_orders.iteritems():
-            symbols_with_orders.add(status['symbol'])
+        symbols_with_orders = set(
+            status['symbol'] for status in self._watched_orders.values())
+        missing = [symbol for symbol in self._targets
+                   if symbol not in symbols_with_orders]
+        # Usually every target has orders. Don't query balances then.
+        if not missing:
+            return
 
         # Reuse this balances to avoid bitfinex ERR_RATE_LIMIT for
         # balance query.
         balances = self._get_balances()
-        for symbol, config in self._targets.iteritems():
-            if symbol not in symbols_with_orders:
-                price = self._get_last_price(symbol)
-                amount = config['unit']
-                self._create_two_paired_orders(mid_price=price, symbol=symbol,
-                                               amount=amount, balances=balances)
+        for symbol in missing:
+            price = self._get_last_price(symbol)
+            amount = self._targets[symbol]['unit']
+            self._create_two_paired_orders(mid_price=price, symbol=symbol,
+                                           amount=amount, balances=balances)
 
     def _check_create_market_orders(self):
         """Checks if any wallet is too less and need to create market order."""
         balances = self._get_balances()
         # Reuse balances
-        for symbol, v in self._targets.iteritems():
+        for symbol, v in self._targets.items():
             coin_info = self._get_wallet_info(currency=v['currency'],
                                               balances=balances)
             coin_amount = coin_info['amount']
@@ -608,7 +700,7 @@ class TradeBot(object):
                 logger.info('%s: Only %s left, less than 3 units: %s. '
                             'Buy 2 units.',
                             symbol, coin_amount, threshold_amount)
-                for _ in xrange(2):
+                for _ in range(2):
                     status = self._create_new_market_order(
                             symbol=symbol,
                             amount=coin_unit,
@@ -625,7 +717,7 @@ class TradeBot(object):
 
     def _check_market_orders(self):
         """Checks and records market order status."""
-        for id in self._watched_market_orders.keys():
+        for id in list(self._watched_market_orders):
             order_status = self._get_order_status(id=id)
             # Can not find this order. Give up this time.
             if order_status is None:
@@ -651,17 +743,23 @@ class TradeBot(object):
         time.sleep(self.WAIT_MARKET_ORDER_SECS)
         self._check_market_orders()
 
+        # Fetch live orders once and share them in the rest of this
+        # iteration to avoid bitfinex ERR_RATE_LIMIT.
+        orders = self._v1_client.orders()
+
         # Check if there is any new open order to be watched.
         # This might happen if there is order before trade starts.
-        self._check_new_watched_orders()
+        self._check_new_watched_orders(orders)
+
+        # Check the watched order status. Do this before creating initial
+        # orders: all watched orders are then covered by `orders`, and only
+        # the ones that left it need a status query.
+        self._check_watched_orders(orders)
 
         # If there is no order being watched for a target, create two orders
         # from current price.
         self._create_initial_orders()
 
-        # Check the watched order status.
-        self._check_watched_orders()
-
         logger.debug('watched_orders: %s', pprint.pformat(self._watched_orders))
         logger.debug('paired_orders: %s', pprint.pformat(self._paired_orders))
 
@@ -671,19 +769,45 @@ class TradeBot(object):
 
     def clean_up_orders(self):
         """Clean up all orders that has matched target/amount."""
-        self._check_new_watched_orders()
+        self._check_new_watched_orders(self._v1_client.orders())
+        if not self._watched_orders:
+            return
+
+        # Cancel all of them in one request. Authenticated requests can not
+        # be sent in parallel because bitfinex requires increasing nonces.
+        # Bitfinex cancels them asynchronously, so they are not verified here.
+        # An order that is left alive is still recorded as should be
+        # cancelled, like with _cancel_order.
         for id in self._watched_orders:
-            self._cancel_order(id)
+            self._save_should_be_cancelled_order(id)
+        try:
+            self._v1_client.cancel_multiple_orders(self._watched_orders)
+        except BitfinexClientError as e:
+            if 'ERR_RATE_LIMIT' in str(e):
+                raise
+            logger.warning('Can not cancel orders at once: %s', e)
+            for id in self._watched_orders:
+                self._send_cancel_order(id)
 
     def check_order_status(self, id):
         print(self._get_order_status(id=id))
 
-    def _save_old_executed_order(self, id):
-        """Saves an order that is executed into db."""
-        self._db.execute("INSERT INTO old_executed_orders VALUES (?)", (id,))
+    def _save_executed_orders(self):
+        """Saves executed orders recorded in this iteration into db."""
+        if not self._executed_rows:
+            return
+        self._db.executemany_all([
+            ("INSERT INTO executed_orders VALUES (?,?,?,?,?)",
+             self._executed_rows),
+            ("INSERT INTO old_executed_orders VALUES (?)",
+             self._executed_ids)])
+        self._executed_rows = []
+        self._executed_ids = []
 
     def _is_old_executed_order(self, id):
         """Checks if an order is executed."""
+        if (id,) in self._executed_ids:
+            return True
         c = self._db.execute("SELECT 1 FROM old_executed_orders WHERE id = (?)", (id,))
         ret = c.fetchone()
         if ret:
@@ -782,6 +906,11 @@ def main():
     # Disable annoying Starting new HTTP connection (1): example.com.
     logging.getLogger("requests").setLevel(logging.WARNING)
 
+    global slack
+    if config.SLACK_ENABLE:
+        slack = slack_utils.SlackPoster(config.SLACK_TOKEN,
+                                        config.SLACK_CHANNEL)
+
     db = None
     # Connect to a database.
     if config.TRADE_JBOT_DB:
@@ -809,7 +938,12 @@ def main():
         log('Tradebot clean up orders', admin=True)
         monitor.clean_up_orders()
 
-    monitor.run()
+    try:
+        monitor.run()
+    finally:
+        # Make sure the exception is posted before the bot exits.
+        if slack:
+            slack.flush()
 
 
 if __name__ == '__main__':
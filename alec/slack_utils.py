@@ -0,0 +1,76 @@
+import logging
+import queue
+import threading
+import time
+
+import requests
+from slacker import Slacker
+
+logger = logging.getLogger(__name__)
+
+
+class SlackPoster(object):
+    """Posts messages to a slack channel from a background thread.
+
+    Posting is an HTTPS round-trip, so callers only enqueue the message and
+    never wait for slack.
+    """
+
+    # Maximum seconds flush() waits, so a slack outage can't block exit.
+    FLUSH_TIMEOUT = 30
+
+    def __init__(self, token, channel, maxsize=0):
+        # Reuse one keep-alive connection instead of a new TLS handshake for
+        # every post. Only the worker thread posts, so one is enough.
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=1))
+        self._slack = Slacker(token, session=session)
+        self._channel = channel
+        # With maxsize, the oldest messages are dropped when slack can't keep
+        # up, so post_message() never blocks.
+        self._queue = queue.Queue(maxsize)
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def post_message(self, text, **kwargs):
+        """Queue a message. Extra arguments are passed to Slacker."""
+        while True:
+            try:
+                self._queue.put_nowait((text, kwargs))
+                return
+            except queue.Full:
+                pass
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+                logger.warning('Slack queue is full, dropped a message')
+            except queue.Empty:
+                pass
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Block until all queued messages are posted or timeout seconds pass.
+
+        Returns: True if all messages were posted.
+        """
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning('Gave up waiting for %d slack messages',
+                                   self._queue.unfinished_tasks)
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            text, kwargs = self._queue.get()
+            try:
+                self._slack.chat.post_message(self._channel, text, **kwargs)
+            except Exception as e:
+                logger.warning('Failed to post slack message: %s', e)
+            finally:
+                self._queue.task_done()